@@ -1,5 +1,9 @@
 # Animations
 DEFAULT_ANIMATION_SPEED = .1
+# Textures
+TEXTURE_CACHE_BUDGET = 64 * 1024 * 1024 # bytes of decoded and scaled surfaces kept around
+ASSET_BUNDLE = "data/assets.bundle" # built by build-assets.py, textures and fonts are loaded the slow way without it
+ATLAS_CACHE = "data/atlases" # animation frames are packed into one sheet here on first use. None packs them every run
 # Background
 BACKGROUND_TEXTURE = "data/background4.png"
 # Explosion
@@ -34,14 +38,65 @@ NUM_AI_CARS = 1
 AI_CAR_SPEED = 25
 AI_CAR_TURNSPEED = 10
 AI_CAR_ACCELERATION = -.3
+AI_FINAL_POSITION_SPACING = .2 # AI car i is paced to be passed (i + 1) * this * ROAD_LENGTH into the race
 
 
 
+# Road
+ROAD_LENGTH = 100000
+ENDLESS = False # No finish line, traffic is generated forever
+TRAFFIC_CHUNK_SIZE = 2000
+TRAFFIC_LOOKAHEAD = 3000 # How far past the top of the screen traffic is generated
+TRAFFIC_WAKE_DISTANCE = 600 # Traffic further than this past the top of the screen sleeps
+CHECKPOINT_SPACING = 1000 # the player's time between two checkpoints is scored
+CHECKPOINT_HEIGHT = 10
+DEBUG_CHECKPOINTS = False # draw the checkpoints on screen
+ENDLESS_SPLITS = 100 # checkpoint times kept on an endless road, older ones are dropped
+TRACK_CACHE = "data/tracks" # traffic layouts of seeded games are saved here and memory mapped on later races. None turns it off
+TRACK_CACHE_FILES = 200 # layouts kept in TRACK_CACHE, the least recently used go first
+
+# Entities
+ENTITY_POOLS = True # Reuse dead NormalCars and Explosions instead of allocating new ones
+
+# AI
+AI_DECISION_INTERVAL = 6 # updates between two lane decisions of the same AI car, cars are staggered over them
+AI_DECISION_BUDGET = 500 # microseconds of lane decisions per frame, the rest carries over to the next frame
+AI_DECISION_COST = 25 # microseconds charged per decision on simulated and replayed clocks instead of timing them
+
+# Physics
+COLLISION_CELL_HEIGHT = 200
+
+# Sound
+SOUND_CATEGORIES = {ENGINE_SOUND: "engine", EXPLOSION_SOUND: "explosion", TIRE_SKID: "skid"} # every sound is loaded at start
+SOUND_CHANNELS = {"engine": 1, "explosion": 4, "skid": 2} # mixer channels reserved for each category
+SOUND_PLAYS_PER_FRAME = {"engine": 1, "explosion": 2, "skid": 1} # further plays in the same frame are dropped
+
+# Profiling
+PROFILE_FRAMES = 600 # frames of stage timings kept, F3 shows them and F4 exports them
+PROFILE_EXPORT = "frame-profile" # F4 writes frame-profile.json (Chrome trace) and frame-profile.csv
+
+# Quality governor
+GOVERNOR = True # lower quality while frames overrun, only with a real time clock
+GOVERNOR_WINDOW = 30 # frames averaged for every decision
+GOVERNOR_HOLD = 90 # frames a quality level is kept at least
+GOVERNOR_DEGRADE = .9 # step down when the mean frame takes more than this much of the frame budget
+GOVERNOR_RESTORE = .35 # step back up when it takes less
+GOVERNOR_LOG = "quality-transitions.csv" # every change is appended here. None turns the log off
+
+# Replays
+RECORD_SESSION = False # record every session to REPLAY_FILE for replay.py
+REPLAY_FILE = "last-session.replay"
+REPLAY_CHUNK = 600 # frames of a recording kept in memory before they are written to the file
+
 # GUI
 WINDOW_TITLE          = "Racing Game"
 WINDOW_ICON           = "data/racing-game-icon.png"
 WINDOW_SIZE           = (600, 700)
 
+SIMULATION_THREAD = False # simulate on a thread of its own, the window draws interpolated snapshots
+RENDER_FPS = 120 # frame rate cap of the render loop when SIMULATION_THREAD is on
+RETAINED_RENDERING = True # Only push the rectangles that changed while the camera holds still
+
 START = "data/start.png"
 FINISH = "data/finish.png"
 FRICTION              = 0.8
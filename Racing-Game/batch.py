@@ -0,0 +1,152 @@
+# Runs seeded headless races over a grid of Constants across worker
+# processes and prints one row of results per grid point. e.g.
+#   python batch.py --races 1000 --grid DIFFICULTY=3,4,5 --grid AI_FINAL_POSITION_SPACING=.15,.2
+#   python batch.py --races 200 --input weave --out tuning
+# The second form also writes every race to tuning.csv and the table to tuning.json.
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+import Constants
+import headless
+
+_runner = None
+
+
+def initWorker():
+    # Every worker keeps one game, and with it the texture cache, for all its races
+    global _runner
+    sys.stdout = open(os.devnull, "w")
+    _runner = headless.HeadlessRunner()
+
+
+def runRace(task):
+    params, seed, inputName, maxFrames = task
+    for name, value in params:
+        setattr(Constants, name, value)
+    _runner.inputSource = headless.makeInput(inputName)
+    _runner.maxFrames = maxFrames
+    result = _runner.run(seed)
+    result["params"] = params
+    return result
+
+
+def parseValue(name, kind, text):
+    # bool("False") is True, so booleans are spelled out
+    if kind == bool and text.lower() in ("true", "false"):
+        return text.lower() == "true"
+    if kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    raise ValueError("Bad value %r for %s, which is a %s" % (text, name, kind.__name__))
+
+
+def parseGrid(specs):
+    # ["DIFFICULTY=3,4"] -> [("DIFFICULTY", [3.0, 4.0])], values keep the type of the constant
+    grid = []
+    for spec in specs:
+        name, values = spec.split("=", 1)
+        if not hasattr(Constants, name):
+            raise ValueError("Unknown constant " + name)
+        kind = type(getattr(Constants, name))
+        if kind not in (int, float, bool):
+            # Values are split on commas, a tuple would be split into characters
+            raise ValueError("%s is a %s, only int, float and bool constants can be swept" % (name, kind.__name__))
+        grid.append((name, [parseValue(name, kind, v) for v in values.split(",")]))
+    return grid
+
+
+def makeTasks(grid, races, seed, inputName, maxFrames):
+    names = [name for name, values in grid]
+    for values in itertools.product(*[values for name, values in grid]):
+        params = tuple(zip(names, values))
+        for i in range(races):
+            yield params, seed + i, inputName, maxFrames
+
+
+def mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def summarize(results):
+    groups = dict()
+    for result in results:
+        groups.setdefault(result["params"], []).append(result)
+    rows = []
+    for params, group in groups.items():
+        finished = [r for r in group if r["finished"]]
+        scores = [score for r in group for score in r["scorelist"]]
+        row = dict(params)
+        row.update({
+            "races": len(group),
+            "finished": len(finished),
+            "placement": mean([r["placement"] for r in group]),
+            "wins": sum(1 for r in group if r["placement"] == 1),
+            "finishTime": mean([r["finishTime"] for r in finished]),
+            "sensorScore": mean(scores),
+            "challenges": mean([r["challenges"] for r in group]),
+        })
+        rows.append(row)
+    return rows
+
+
+def printTable(rows, names):
+    columns = names + ["races", "finished", "wins", "placement", "finishTime", "sensorScore", "challenges"]
+    print(" ".join("%14s" % c[:14] for c in columns))
+    for row in rows:
+        cells = []
+        for c in columns:
+            value = row[c]
+            cells.append("%14s" % ("-" if value == None else round(value, 3) if isinstance(value, float) else value))
+        print(" ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--races", type=int, default=100, help="seeded races per grid point")
+    parser.add_argument("--grid", action="append", default=[], metavar="NAME=V1,V2",
+                        help="a Constants value to sweep, may be given more than once")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--input", default="ai", choices=["ai", "straight", "weave"])
+    parser.add_argument("--max-frames", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--out", metavar="PREFIX", help="write PREFIX.csv with every race and PREFIX.json with the table")
+    args = parser.parse_args()
+
+    try:
+        grid = parseGrid(args.grid)
+    except ValueError as e:
+        parser.error(str(e))
+    names = [name for name, values in grid]
+    tasks = list(makeTasks(grid, args.races, args.seed, args.input, args.max_frames))
+    # Big chunks keep the workers busy instead of waiting on the parent
+    chunksize = max(1, len(tasks) // (args.workers * 4))
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(args.workers, initializer=initWorker) as executor:
+        results = list(executor.map(runRace, tasks, chunksize=chunksize))
+    elapsed = time.perf_counter() - start
+    frames = sum(r["frames"] for r in results)
+    print("%d races, %d frames in %.1fs on %d workers (%.0f races/s)" % (len(results), frames, elapsed, args.workers, len(results) / elapsed))
+
+    rows = summarize(results)
+    printTable(rows, names)
+    if args.out:
+        with open(args.out + ".csv", "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(names + ["seed", "frames", "finished", "finishTime", "placement", "score", "challenges", "scorelist"])
+            for r in results:
+                writer.writerow([value for name, value in r["params"]] + [r["seed"], r["frames"], r["finished"], r["finishTime"],
+                                r["placement"], r["score"], r["challenges"], " ".join(str(s) for s in r["scorelist"])])
+        with open(args.out + ".json", "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+# pyperf benchmarks for the game's hot paths, run headless. e.g.
+#   python benchmark.py -o results.json
+#   python benchmark.py --curves scaling
+# The second form skips pyperf and writes scaling.json and scaling.csv with
+# the time per call for every scenario at every entity count.
+import csv
+import importlib
+import json
+import os
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pyperf
+
+game = importlib.import_module("racing-game-fixed")
+
+# Traffic is spread over this many screens ahead of the start line
+SCENE_SCREENS = 5
+SCENE_START = -400
+
+_game = None
+
+
+def getGame():
+    global _game
+    if _game == None:
+        _game = game.Game(run=False, clock=game.SimulationClock())
+    return _game
+
+
+def scene(normalCars=0, explosions=0, sleeping=False):
+    # A race that has just started, with exactly normalCars cars of traffic
+    # and explosions explosions on screen. All the traffic is awake unless
+    # sleeping, then it is spawned like a race does and sleeps past the wake line
+    g = getGame()
+    g.rng.seed(0)
+    g.reset()
+    g.state = g.STATE_PLAYING
+    g.starttime = g.clock.now()
+    g.score.startTimer()
+    for c in g.normalCars:
+        g.entities.destroy(c)
+    g.removeDead()
+    g.sleepers.clear()
+    g.traffic.clearSleepers()
+    g.trafficChunks = None
+    lanes = g.road.lanes
+    span = SCENE_SCREENS * g.gui.h
+    for i in range(normalCars):
+        y = SCENE_START - span * i / max(normalCars, 1)
+        if sleeping:
+            g.spawnNormalCar(lanes[i % len(lanes)], y, None)
+        else:
+            g.addNormalCar(lanes[i % len(lanes)], y, None)
+    top = -g.camera.yOffset
+    for i in range(explosions):
+        x = g.road.x + (i * 37) % g.road.w - 150
+        y = top + (i * 53) % g.gui.h - 150
+        explosion = g.explosionPool.acquire(g, (x, y), (300, 300))
+        g.entities.add(explosion, ("objects", "effects"))
+        g.traffic.add(explosion)
+    return g
+
+
+def timeCalls(setup, func, loops):
+    # Only func is timed, setup runs before every call
+    total = 0.0
+    for i in range(loops):
+        arg = setup()
+        start = time.perf_counter()
+        func(arg)
+        total += time.perf_counter() - start
+    return total
+
+
+def benchPhysics(count):
+    def run(loops):
+        g = scene(count)
+        start = time.perf_counter()
+        for i in range(loops):
+            g.doPhysics()
+        return time.perf_counter() - start
+    return run
+
+
+def benchDraw(count, explosions=0):
+    def run(loops):
+        g = scene(count, explosions)
+        start = time.perf_counter()
+        for i in range(loops):
+            g.drawObjects()
+        return time.perf_counter() - start
+    return run
+
+
+def benchUpdate(count, explosions=0, sleeping=False):
+    def run(loops):
+        g = scene(count, explosions, sleeping)
+        start = time.perf_counter()
+        for i in range(loops):
+            g.update()
+        return time.perf_counter() - start
+    return run
+
+
+def benchFrame(count, explosions=0, sleeping=False):
+    def run(loops):
+        g = scene(count, explosions, sleeping)
+        start = time.perf_counter()
+        for i in range(loops):
+            g.clock.tick(g.fps)
+            g.doPlayingLogic()
+        return time.perf_counter() - start
+    return run
+
+
+def benchChooseLane(count):
+    def run(loops):
+        g = scene(count)
+        car = g.aiCars[0]
+        start = time.perf_counter()
+        for i in range(loops):
+            car.chooseLane()
+            del car.lanes[1:]
+        return time.perf_counter() - start
+    return run
+
+
+def benchReset(loops):
+    g = getGame()
+    g.rng.seed(0)
+    start = time.perf_counter()
+    for i in range(loops):
+        g.reset()
+    return time.perf_counter() - start
+
+
+def benchPlaceCars(loops):
+    def setup():
+        g = scene(0)
+        return g
+    return timeCalls(setup, lambda g: g.placeCars(), loops)
+
+
+def benchRemoveDead(count):
+    def run(loops):
+        def setup():
+            g = scene(count)
+            for c in g.normalCars[::2]:
+                g.entities.destroy(c)
+            return g
+        return timeCalls(setup, lambda g: g.removeDead(), loops)
+    return run
+
+
+def benchLoadExplosion(cold):
+    def run(loops):
+        getGame()
+        def setup():
+            if cold:
+                game.Texture.cache.clear()
+                game.TextureAtlas.loaded.clear()
+        def load(arg):
+            texture = game.AnimatedTexture(game.Constants.EXPLOSION_IMAGE, game.Constants.EXPLOSION_NUMFRAMES[0], False, .1)
+            texture.scaleTo(game.Constants.EXPLOSION_SIZE[0])
+        return timeCalls(setup, load, loops)
+    return run
+
+
+def benchmarks(densities):
+    yield "reset", benchReset
+    yield "placeCars", benchPlaceCars
+    yield "load-explosion-cold", benchLoadExplosion(True)
+    yield "load-explosion-warm", benchLoadExplosion(False)
+    for count in densities:
+        yield "doPhysics-%d" % count, benchPhysics(count)
+        yield "drawObjects-%d" % count, benchDraw(count)
+        yield "update-%d" % count, benchUpdate(count)
+        yield "chooseLane-%d" % count, benchChooseLane(count)
+        yield "removeDead-%d" % count, benchRemoveDead(count)
+        yield "frame-%d" % count, benchFrame(count)
+    # Stress scenarios
+    yield "frame-5000-cars", benchFrame(5000)
+    yield "update-5000-sleeping", benchUpdate(5000, sleeping=True)
+    yield "frame-5000-sleeping", benchFrame(5000, sleeping=True)
+    yield "frame-200-explosions", benchFrame(0, 200)
+    yield "drawObjects-200-explosions", benchDraw(0, 200)
+
+
+def curves(counts, explosionCounts, loops):
+    scenarios = [
+        ("doPhysics", benchPhysics),
+        ("drawObjects", benchDraw),
+        ("update", benchUpdate),
+        ("chooseLane", benchChooseLane),
+        ("removeDead", benchRemoveDead),
+        ("frame", benchFrame),
+        ("update-sleeping", lambda count: benchUpdate(count, sleeping=True)),
+        ("frame-sleeping", lambda count: benchFrame(count, sleeping=True)),
+    ]
+    rows = []
+    scenarios = [(name, make, counts) for name, make in scenarios]
+    scenarios.append(("explosions-frame", lambda count: benchFrame(0, count), explosionCounts))
+    for name, make, entityCounts in scenarios:
+        for count in entityCounts:
+            ms = make(count)(loops) / loops * 1000
+            rows.append({"scenario": name, "entities": count, "ms": ms})
+            print("%-18s %6d %10.4f ms" % (name, count, ms))
+    return rows
+
+
+def addCmdlineArgs(cmd, args):
+    cmd.extend(("--densities", args.densities))
+
+
+def main():
+    runner = pyperf.Runner(add_cmdline_args=addCmdlineArgs)
+    runner.argparser.add_argument("--densities", default="100,1000,5000",
+                                  help="comma separated NormalCar counts")
+    runner.argparser.add_argument("--curves", metavar="PREFIX",
+                                  help="write scaling curves to PREFIX.json and PREFIX.csv instead of running pyperf")
+    runner.argparser.add_argument("--curve-counts", default="0,100,250,500,1000,2000,5000")
+    runner.argparser.add_argument("--curve-explosion-counts", default="0,25,50,100,200")
+    runner.argparser.add_argument("--curve-loops", type=int, default=50)
+    args = runner.parse_args()
+
+    if args.curves:
+        counts = [int(c) for c in args.curve_counts.split(",")]
+        explosionCounts = [int(c) for c in args.curve_explosion_counts.split(",")]
+        rows = curves(counts, explosionCounts, args.curve_loops)
+        with open(args.curves + ".json", "w") as f:
+            json.dump(rows, f, indent=2)
+        with open(args.curves + ".csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, ["scenario", "entities", "ms"])
+            writer.writeheader()
+            writer.writerows(rows)
+        return
+
+    densities = [int(d) for d in args.densities.split(",")]
+    for name, func in benchmarks(densities):
+        runner.bench_time_func(name, func)
+
+
+if __name__ == "__main__":
+    main()
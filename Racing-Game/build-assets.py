@@ -0,0 +1,164 @@
+# Packs every texture the game loads, at the sizes it asks for and animations
+# as their atlas sheets, every sound decoded to mixer samples and the font
+# files SysFont resolves to into one bundle (Constants.ASSET_BUNDLE). e.g.
+#   python build-assets.py
+#   python build-assets.py --measure 5
+# The second form also times fresh processes with and without the bundle: from
+# start to the first drawn frame, the part of that after the imports, and the
+# first explosion, which loads 30 frames mid race.
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import Constants
+import pygame
+
+# Names passed to loadFont
+FONTS = ("monospace", "arial")
+# Pixel layout of convert_alpha() surfaces on a 32 bit display
+FORMAT = "BGRA"
+
+COLD_START = """
+import time
+start = time.perf_counter()
+import importlib, os, sys
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+sys.stdout = open(os.devnull, "w")
+import Constants
+Constants.ASSET_BUNDLE = None if sys.argv[1] == "none" else sys.argv[1]
+game = importlib.import_module("racing-game-fixed")
+imported = time.perf_counter()
+g = game.Game(run=False)
+g.step()
+firstFrame = time.perf_counter()
+game.Explosion(g, (0, 0), (300, 300))
+explosion = time.perf_counter() - firstFrame
+sys.stdout = sys.__stdout__
+print(firstFrame - start, firstFrame - imported, explosion)
+"""
+
+
+def collectSurfaces():
+    # Every texture a race draws, at the sizes it draws them, loaded the slow
+    # way. They are listed rather than taken from whatever one Game happened
+    # to load, traffic for one starts out asleep without its texture.
+    Constants.ASSET_BUNDLE = None
+    game = importlib.import_module("racing-game-fixed")
+    g = game.Game(run=False)
+    game.Texture.cache.clear()
+    banner = (g.road.w, 250)
+    textures = [
+        (Constants.BACKGROUND_TEXTURE, (g.gui.w, g.gui.h)),
+        (Constants.START, banner),
+        (Constants.FINISH, banner),
+        (Constants.PLAYER_CAR_IMAGE, Constants.CAR_SIZE),
+    ]
+    animations = [
+        (Constants.AI_CAR_IMAGE, Constants.NUM_AI_CARS, Constants.CAR_SIZE),
+        (Constants.NORMAL_CAR_IMAGE, Constants.NUM_NORMAL_CARS, Constants.CAR_SIZE),
+        (Constants.EXPLOSION_IMAGE, Constants.EXPLOSION_NUMFRAMES[0], (300, 300)),
+    ]
+    for filename, size in textures:
+        game.Texture(filename).scaleTo(size)
+    for filename, numFrames, size in animations:
+        game.AnimatedTexture(filename, numFrames, False, -1).scaleTo(size)
+    return list(game.Texture.cache.surfaces.items())
+
+
+def resolveFont(name):
+    path = pygame.font.match_font(name)
+    if path != None:
+        return path, 1.0
+    # SysFont falls back to pygame's own font, drawn smaller than asked
+    return os.path.join(os.path.dirname(pygame.__file__), pygame.font.get_default_font()), .6875
+
+
+def align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def build(filename):
+    game = importlib.import_module("racing-game-fixed")
+    blobs = []
+    index = {"sources": {}, "surfaces": [], "sounds": {}, "fonts": {}}
+    for (path, frame, size), surface in collectSurfaces():
+        source = game.Texture.cache.framePath(path, frame)
+        if not os.path.exists(source):
+            # Atlases packed in memory, without Constants.ATLAS_CACHE
+            continue
+        index["sources"][source] = os.path.getmtime(source)
+        data = pygame.image.tobytes(surface, FORMAT)
+        w, h = surface.get_size()
+        index["surfaces"].append({"path": path, "frame": frame, "source": source, "size": None if size == None else list(size),
+                                  "w": w, "h": h, "format": FORMAT, "length": len(data)})
+        blobs.append(data)
+    for path in sorted(Constants.SOUND_CATEGORIES):
+        index["sources"][path] = os.path.getmtime(path)
+        data = pygame.mixer.Sound(path).get_raw()
+        index["sounds"][path] = {"mixer": list(pygame.mixer.get_init()), "length": len(data)}
+        blobs.append(data)
+    for name in FONTS:
+        path, scale = resolveFont(name)
+        with open(path, "rb") as f:
+            data = f.read()
+        index["fonts"][name] = {"file": path, "scale": scale, "length": len(data)}
+        blobs.append(data)
+
+    # Offsets depend on the index length, which depends on the offsets, so
+    # leave room for them before laying out the data
+    entries = index["surfaces"] + list(index["sounds"].values()) + list(index["fonts"].values())
+    for entry in entries:
+        entry["offset"] = 0
+    indexLength = len(json.dumps(index)) + 32 * len(entries)
+    offset = align(game.AssetBundle.HEADER.size + indexLength, game.AssetBundle.ALIGN)
+    for entry in entries:
+        entry["offset"] = offset
+        offset = align(offset + entry["length"], game.AssetBundle.ALIGN)
+    text = json.dumps(index).encode()
+    assert len(text) <= indexLength
+    text += b" " * (indexLength - len(text))
+
+    def write(f):
+        f.write(game.AssetBundle.HEADER.pack(game.AssetBundle.MAGIC, game.AssetBundle.VERSION, indexLength))
+        f.write(text)
+        for entry, data in zip(entries, blobs):
+            f.write(b"\0" * (entry["offset"] - f.tell()))
+            f.write(data)
+    game.replaceFile(filename, write)
+    print("Wrote %d surfaces, %d sounds and %d fonts to %s (%.1f MB)" % (
+        len(index["surfaces"]), len(index["sounds"]), len(index["fonts"]), filename, offset / 1e6))
+
+
+def coldStart(bundle, runs):
+    # Best of runs for each measurement
+    best = None
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, "-c", COLD_START, bundle], stderr=subprocess.DEVNULL)
+        times = [float(t) for t in out.decode().split()[-3:]]
+        best = times if best == None else [min(a, b) for a, b in zip(best, times)]
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default=Constants.ASSET_BUNDLE)
+    parser.add_argument("--measure", type=int, metavar="RUNS", default=0,
+                        help="time RUNS fresh starts to the first frame with and without the bundle")
+    args = parser.parse_args()
+
+    build(args.out)
+    if args.measure:
+        print("%-7s %12s %12s %12s" % ("ms", "first frame", "after import", "explosion"))
+        for name, bundle in (("decode", "none"), ("bundle", args.out)):
+            print("%-7s %12.1f %12.1f %12.1f" % tuple([name] + [t * 1000 for t in coldStart(bundle, args.measure)]))
+
+
+if __name__ == "__main__":
+    main()
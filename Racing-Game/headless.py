@@ -0,0 +1,154 @@
+# Runs races without a window or sound card, on a fixed timestep, as fast
+# as the CPU allows. e.g.
+#   python headless.py --races 10 --input ai --seed 1
+import argparse
+import importlib
+import os
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+game = importlib.import_module("racing-game-fixed")
+
+
+class ScriptedInput:
+    # Plays back a list of (frames, steering) segments, steering being -1, 0 or 1
+    def __init__(self, script, loop=True):
+        self.script = script
+        self.loop = loop
+        self.frame = 0
+        self.length = sum(frames for frames, steering in script)
+
+    def wantsStart(self, engine):
+        return True
+
+    def steering(self, engine):
+        frame = self.frame
+        self.frame += 1
+        if self.loop:
+            frame %= self.length
+        for frames, steering in self.script:
+            if frame < frames:
+                return steering
+            frame -= frames
+        return 0
+
+
+class AIInput:
+    # Drives the player car towards whichever lane has the most room ahead
+    def __init__(self, lookahead=600):
+        self.lookahead = lookahead
+        self.target = None
+
+    def wantsStart(self, engine):
+        return True
+
+    def steering(self, engine):
+        car = engine.playerCar
+        road = engine.road
+        lane = road.getLaneObjectIsIn(car)
+        if lane == None:
+            lane = road.lanes[len(road.lanes) // 2]
+        if self.target == None or abs(car.x + car.w / 2 - self.target.center) < car.turnSpeed:
+            best = None
+            for candidate in [lane] + road.getAdjacentLanes(lane):
+                room = self.room(engine, candidate)
+                if best == None or room > bestRoom:
+                    best, bestRoom = candidate, room
+            self.target = best
+        dx = self.target.center - (car.x + car.w / 2)
+        if abs(dx) < car.turnSpeed:
+            return 0
+        return 1 if dx > 0 else -1
+
+    def room(self, engine, lane):
+        car = engine.playerCar
+        o = engine.traffic.nearestAhead(lane, car.y + car.h, car)
+        if o == None:
+            return self.lookahead
+        return min(self.lookahead, car.y - o.y)
+
+
+class HeadlessRunner:
+    def __init__(self, inputSource=None, dt=1.0 / 60, maxFrames=100000, render=False):
+        self.inputSource = inputSource
+        self.dt = dt
+        self.maxFrames = maxFrames
+        self.render = render
+        self.game = None
+
+    def run(self, seed=None):
+        inputSource = self.inputSource if self.inputSource != None else AIInput()
+        if self.game == None:
+            self.game = game.Game(run=False, clock=game.SimulationClock(self.dt), inputSource=inputSource, render=self.render, seed=seed)
+        else:
+            if seed != None:
+                self.game.rng.seed(seed)
+            # Every race starts at t=0 so results do not depend on what ran before
+            self.game.clock.t = 0.0
+            self.game.input = inputSource
+            self.game.first = False
+        g = self.game
+        g.done = False
+        g.state = g.STATE_WAITING
+        start = time.perf_counter()
+        frames = 0
+        while not g.done and frames < self.maxFrames:
+            g.step()
+            g.clock.tick(g.fps)
+            frames += 1
+            if g.finished:
+                break
+        return {
+            "seed": seed,
+            "frames": frames,
+            "finished": g.finished,
+            "finishTime": g.finishTime,
+            "placement": g.placement,
+            "scorelist": list(g.scorelist),
+            "score": g.score.value,
+            "challenges": g.challenges,
+            "splits": list(g.splits),
+            "wallTime": time.perf_counter() - start,
+        }
+
+    def quit(self):
+        if self.game != None:
+            self.game.quit()
+            self.game = None
+
+
+def makeInput(name):
+    if name == "ai":
+        return AIInput()
+    if name == "straight":
+        return ScriptedInput([(1, 0)])
+    if name == "weave":
+        return ScriptedInput([(12, 0), (12, -1), (12, 0), (12, 1)])
+    raise ValueError("Unknown input source " + name)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--races", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--input", default="ai", choices=["ai", "straight", "weave"])
+    parser.add_argument("--dt", type=float, default=1.0 / 60)
+    parser.add_argument("--max-frames", type=int, default=100000)
+    parser.add_argument("--render", action="store_true")
+    args = parser.parse_args()
+
+    runner = HeadlessRunner(dt=args.dt, maxFrames=args.max_frames, render=args.render)
+    for i in range(args.races):
+        runner.inputSource = makeInput(args.input)
+        seed = None if args.seed == None else args.seed + i
+        result = runner.run(seed)
+        print("race %d: %d frames in %.2fs (%.0f fps), finished=%s time=%s placement=%s scores=%s" % (
+            i, result["frames"], result["wallTime"], result["frames"] / result["wallTime"], result["finished"],
+            None if result["finishTime"] == None else round(result["finishTime"], 3), result["placement"], result["scorelist"]))
+    runner.quit()
+
+
+if __name__ == "__main__":
+    main()
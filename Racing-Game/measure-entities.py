@@ -0,0 +1,95 @@
+# Reports bytes per entity and entity allocations per frame, with and
+# without the entity pools. Runs headless, e.g.
+#   python measure-entities.py --frames 2000
+import argparse
+import importlib
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import Constants
+game = importlib.import_module("racing-game-fixed")
+
+
+class DictLayout(object):
+    # Same attributes as an entity, stored in a __dict__ like before __slots__
+    def __init__(self, entity):
+        for cls in type(entity).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                setattr(self, name, getattr(entity, name, None))
+
+
+def makeGame(pools):
+    Constants.ENTITY_POOLS = pools
+    g = game.Game(run=False)
+    g.state = g.STATE_PLAYING
+    g.starttime = g.clock.now()
+    g.score.startTimer()
+    return g
+
+
+def objectBytes(entity):
+    layout = DictLayout(entity)
+    return sys.getsizeof(entity), sys.getsizeof(layout) + sys.getsizeof(layout.__dict__)
+
+
+def bytesPerEntity(make, count):
+    # Everything one more entity costs, including its texture object
+    make()  # warm the texture cache
+    entities = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(count):
+        entities.append(make())
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum(stat.size_diff for stat in after.compare_to(before, "filename")) / count
+
+
+def allocationsPerFrame(pools, frames):
+    g = makeGame(pools)
+    start = time.perf_counter()
+    for i in range(frames):
+        if i % 10 == 0:
+            # Chain explosions across everything on screen
+            for car in g.normalCars:
+                if g.camera.canSee((car.x, car.y), (car.w, car.h)):
+                    car.explode(300)
+        g.doPlayingLogic()
+    elapsed = time.perf_counter() - start
+    created = g.normalCarPool.created + g.explosionPool.created
+    reused = g.normalCarPool.reused + g.explosionPool.reused
+    g.quit()
+    return created / frames, reused / frames, elapsed / frames * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--count", type=int, default=500)
+    args = parser.parse_args()
+
+    g = makeGame(True)
+    lane = g.road.lanes[0]
+    normalCar = lambda: game.NormalCar(g, (lane.x, -1000), None)
+    explosion = lambda: game.Explosion(g, (lane.x, -1000), (300, 300))
+    print("%-12s %10s %10s %10s %10s" % ("entity", "slots", "__dict__", "total", "total old"))
+    for name, make in (("NormalCar", normalCar), ("Explosion", explosion)):
+        slotted, dictLayout = objectBytes(make())
+        total = bytesPerEntity(make, args.count)
+        print("%-12s %10d %10d %10.0f %10.0f" % (name, slotted, dictLayout, total, total - slotted + dictLayout))
+    g.quit()
+
+    print("")
+    print("%-8s %14s %14s %10s" % ("pools", "created/frame", "reused/frame", "ms/frame"))
+    for pools in (False, True):
+        created, reused, ms = allocationsPerFrame(pools, args.frames)
+        print("%-8s %14.3f %14.3f %10.3f" % (pools, created, reused, ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,414 @@
+import array
+import bisect
+import collections
 import Constants
+import io
+import json
 import math
+import mmap
+import numpy
 import operator
 import os
 import pygame
+import queue
 import random
+import struct
+import threading
 import time
+import zlib
 from functools import *
 
+class RealClock:
+    # Runs on a reproducible clock have to come out the same every time, so
+    # nothing may depend on how long the work took
+    reproducible = False
+
+    def __init__(self):
+        self.clock = pygame.time.Clock()
+
+    def now(self):
+        return time.time()
+
+    def tick(self, fps):
+        self.clock.tick(fps)
+
+class SimulationClock:
+    # Advances a fixed dt every tick, no matter how long the frame took
+    reproducible = True
+
+    def __init__(self, dt=1.0 / 60, start=0.0):
+        self.dt = dt
+        self.t = start
+
+    def now(self):
+        return self.t
+
+    def tick(self, fps):
+        self.t += self.dt
+
+class RecordingClock(RealClock):
+    # Real time, but read once per frame and kept in whole microseconds so a
+    # replay can hand the game exactly the same values. The frame times pile
+    # up as deltas until a ReplayWriter takes them.
+    reproducible = True
+
+    def __init__(self):
+        RealClock.__init__(self)
+        self.start = time.perf_counter()
+        self.micros = 0
+        self.deltas = array.array("I")
+
+    def now(self):
+        return self.micros / 1000000.0
+
+    def tick(self, fps):
+        RealClock.tick(self, fps)
+        micros = int((time.perf_counter() - self.start) * 1000000)
+        self.deltas.append(micros - self.micros)
+        self.micros = micros
+
+    def takeDeltas(self):
+        deltas = self.deltas
+        self.deltas = array.array("I")
+        return deltas
+
+class ReplayClock:
+    # Plays back the frame times of a RecordingClock, either as fast as
+    # possible or paced like the recorded session
+    reproducible = True
+
+    def __init__(self, micros, realtime=False):
+        self.micros = micros
+        self.realtime = realtime
+        self.frame = 0
+        self.start = time.perf_counter()
+
+    def now(self):
+        return self.micros[min(self.frame, len(self.micros) - 1)] / 1000000.0
+
+    def tick(self, fps):
+        self.frame += 1
+        if self.realtime and self.frame < len(self.micros):
+            delay = self.start + self.micros[self.frame] / 1000000.0 - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+# Everything that needs the time asks this clock, Game can swap it out
+gameClock = RealClock()
+# Packed textures, sounds and fonts, Game opens Constants.ASSET_BUNDLE
+assets = None
+
+class TextureCache:
+    # Decoded and scaled surfaces keyed by (path, frame, size). Surfaces are
+    # shared between every texture that asks for them, so nothing may draw
+    # onto them. Least recently used entries are dropped past the budget.
+    def __init__(self, budget):
+        self.budget = budget
+        self.surfaces = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Surfaces made at runtime that no file holds, by path. Never evicted
+        self.sources = dict()
+
+    def get(self, path, frame=None, size=None, atlas=None):
+        if size != None:
+            size = (int(size[0]), int(size[1]))
+        key = (path, frame, size)
+        surface = self.lookup(key)
+        if surface != None:
+            return surface
+        self.misses += 1
+        if assets != None:
+            surface = assets.surface(key)
+        if surface == None and size == None and frame == None:
+            surface = self.sources.get(path)
+        if surface == None and size == None:
+            surface = pygame.image.load(self.framePath(path, frame)).convert_alpha()
+        elif surface == None and atlas != None:
+            # size is the size of one frame of the atlas
+            surface = atlas.scale(self.get(path, frame), size)
+        elif surface == None:
+            surface = pygame.transform.smoothscale(self.get(path, frame), size)
+        self.surfaces[key] = surface
+        self.bytes += self.sizeOf(surface)
+        self.evict()
+        return surface
+
+    def lookup(self, key):
+        surface = self.surfaces.get(key)
+        if surface != None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+        return surface
+
+    def framePath(self, path, frame):
+        if frame == None:
+            return path
+        name, ext = os.path.splitext(path)
+        return name + "-" + str(frame) + ext
+
+    def sizeOf(self, surface):
+        return surface.get_pitch() * surface.get_height()
+
+    def evict(self):
+        while self.bytes > self.budget and len(self.surfaces) > 1:
+            key, surface = self.surfaces.popitem(last=False)
+            self.bytes -= self.sizeOf(surface)
+            self.evictions += 1
+
+    def clear(self):
+        self.surfaces.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.surfaces), "bytes": self.bytes,
+                "hitRate": self.hits / lookups if lookups else 0}
+
+def mapTable(filename, kind):
+    # Memory maps a file that starts with kind.HEADER (magic, version, table
+    # length) and a JSON table. Returns the mapping, the table and where the
+    # table ends, or None when the file is not a whole one of kind's version.
+    try:
+        with open(filename, "rb") as f:
+            # Copy on write, surfaces need a writable buffer but nothing draws on them
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, tableLength = kind.HEADER.unpack_from(data)
+        end = kind.HEADER.size + tableLength
+        if magic != kind.MAGIC or version != kind.VERSION or end > len(data):
+            data.close()
+            return None
+        return data, json.loads(data[kind.HEADER.size:end]), end
+    except (OSError, ValueError, struct.error) as e:
+        # Empty or cut short
+        print ("Could not load " + filename + ": " + str(e))
+        return None
+
+def replaceFile(filename, write):
+    # write(f) fills a file next to filename, which is then moved over it, so
+    # a reader never sees half a file
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(temp, "wb") as f:
+        write(f)
+    os.replace(temp, filename)
+
+class AssetBundle:
+    # Surfaces at their final size and pixel format, sounds as mixer samples and
+    # font files, packed by build-assets.py. The file is memory mapped and
+    # surfaces and sounds are made straight from its buffers, so nothing is
+    # decoded or scaled. Entries whose source file changed since the build are
+    # ignored and loaded the slow way.
+    MAGIC = b"RGAB"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHI")
+    ALIGN = 64
+    # pygame draws its built in font at this fraction of the requested size
+    DEFAULT_FONT_SCALE = .6875
+
+    def __init__(self, data, index):
+        self.data = data
+        self.view = memoryview(data)
+        stale = set(path for path, mtime in index["sources"].items()
+                    if not os.path.exists(path) or os.path.getmtime(path) != mtime)
+        self.surfaces = dict()
+        for entry in index["surfaces"]:
+            if entry["source"] in stale:
+                continue
+            size = None if entry["size"] == None else tuple(entry["size"])
+            self.surfaces[(entry["path"], entry["frame"], size)] = entry
+        self.sounds = dict((path, entry) for path, entry in index["sounds"].items() if not path in stale)
+        self.fonts = index["fonts"]
+
+    @staticmethod
+    def open(filename):
+        if filename == None or not os.path.exists(filename):
+            return None
+        mapped = mapTable(filename, AssetBundle)
+        if mapped != None:
+            data, index, end = mapped
+            entries = index["surfaces"] + list(index["sounds"].values()) + list(index["fonts"].values())
+            if all(entry["offset"] + entry["length"] <= len(data) for entry in entries):
+                return AssetBundle(data, index)
+        print ("Ignoring asset bundle " + filename + ", run build-assets.py to make it again")
+        return None
+
+    def surface(self, key):
+        entry = self.surfaces.get(key)
+        if entry == None:
+            return None
+        start = entry["offset"]
+        return pygame.image.frombuffer(self.view[start:start + entry["length"]], (entry["w"], entry["h"]), entry["format"])
+
+    def discard(self, path):
+        self.surfaces = dict((key, entry) for key, entry in self.surfaces.items() if key[0] != path)
+
+    def sound(self, filename):
+        entry = self.sounds.get(filename)
+        # Samples are stored in the mixer format of the build and only fit that
+        if entry == None or tuple(entry["mixer"]) != pygame.mixer.get_init():
+            return None
+        start = entry["offset"]
+        return pygame.mixer.Sound(buffer=self.view[start:start + entry["length"]])
+
+    def font(self, name, size):
+        entry = self.fonts.get(name)
+        if entry == None:
+            return None
+        start = entry["offset"]
+        return pygame.font.Font(io.BytesIO(self.view[start:start + entry["length"]]), int(size * entry["scale"]))
+
+loadedFonts = dict()
+
+def loadFont(name, size):
+    # Fonts come from the asset bundle when there is one, SysFont resolves them otherwise
+    key = (name, size)
+    font = loadedFonts.get(key)
+    if font == None:
+        if assets != None:
+            font = assets.font(name, size)
+        if font == None:
+            font = pygame.font.SysFont(name, size)
+        loadedFonts[key] = font
+    return font
+
+class TextureAtlas:
+    # The frames of an animation packed into one sheet. Sheets are saved to
+    # Constants.ATLAS_CACHE the first time, as a JSON table of where each frame
+    # is followed by the pixels, and memory mapped from there after, so nothing
+    # is decoded. They are packed again when a frame file changes. A sheet is
+    # scaled once per size and the frames handed out are subsurfaces of it,
+    # shared by every texture of the animation.
+    MAGIC = b"RGTA"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHI")
+    ALIGN = 64
+    FORMAT = "BGRA"
+    loaded = dict()
+
+    def __init__(self, path, rects, columns, data=None):
+        self.path = path
+        self.rects = rects
+        self.columns = columns
+        # Keeps the mapping open as long as the sheet points into it
+        self.data = data
+        # The frames handed out per size, with the sheet they are cut from
+        self.views = dict()
+
+    @staticmethod
+    def get(filename, numFrames):
+        key = (filename, numFrames)
+        atlas = TextureAtlas.loaded.get(key)
+        if atlas == None:
+            atlas = TextureAtlas.load(filename, numFrames, Constants.ATLAS_CACHE)
+            TextureAtlas.loaded[key] = atlas
+        return atlas
+
+    @staticmethod
+    def filename(directory, filename):
+        return os.path.join(directory, os.path.splitext(os.path.normpath(filename))[0].replace(os.sep, "-") + ".atlas")
+
+    @staticmethod
+    def pixels(tableLength):
+        # Offset of the pixels, after the header and the table
+        size = TextureAtlas.HEADER.size + tableLength
+        return (size + TextureAtlas.ALIGN - 1) // TextureAtlas.ALIGN * TextureAtlas.ALIGN
+
+    @staticmethod
+    def load(filename, numFrames, directory):
+        # The sheet goes into Texture.cache.sources under the atlas path
+        sources = [Texture.cache.framePath(filename, i) for i in range(numFrames)]
+        mtimes = dict((source, os.path.getmtime(source)) for source in sources)
+        if directory == None:
+            path = Texture.cache.framePath(filename, "atlas")
+        else:
+            path = TextureAtlas.filename(directory, filename)
+            mapped = mapTable(path, TextureAtlas) if os.path.exists(path) else None
+            if mapped != None:
+                data, table, end = mapped
+                w, h = table["size"]
+                offset = TextureAtlas.pixels(end - TextureAtlas.HEADER.size)
+                if table["sources"] == mtimes and offset + w * h * 4 <= len(data):
+                    Texture.cache.sources[path] = pygame.image.frombuffer(memoryview(data)[offset:offset + w * h * 4], (w, h), TextureAtlas.FORMAT)
+                    return TextureAtlas(path, [tuple(rect) for rect in table["frames"]], table["columns"], data)
+                data.close()
+        sheet, rects, columns = TextureAtlas.pack([pygame.image.load(source).convert_alpha() for source in sources])
+        atlas = TextureAtlas(path, rects, columns)
+        Texture.cache.sources[path] = sheet
+        if assets != None:
+            # Whatever the bundle holds of the sheet was made from the old frames
+            assets.discard(path)
+        if directory != None:
+            try:
+                atlas.save(sheet, mtimes)
+            except OSError as e:
+                print ("Could not save texture atlas: " + str(e))
+        return atlas
+
+    @staticmethod
+    def pack(surfaces):
+        # A grid of cells as big as the largest frame, about as wide as high
+        w = max(surface.get_width() for surface in surfaces)
+        h = max(surface.get_height() for surface in surfaces)
+        columns = int(math.ceil(math.sqrt(len(surfaces))))
+        rows = (len(surfaces) + columns - 1) // columns
+        sheet = pygame.Surface((columns * w, rows * h), pygame.SRCALPHA, surfaces[0])
+        rects = []
+        for i, surface in enumerate(surfaces):
+            rect = ((i % columns) * w, (i // columns) * h) + surface.get_size()
+            # Max against the transparent sheet copies the frame including its alpha
+            sheet.blit(surface, rect[:2], special_flags=pygame.BLEND_RGBA_MAX)
+            rects.append(rect)
+        return sheet, rects, columns
+
+    def save(self, sheet, sources):
+        table = json.dumps({"sources": sources, "size": sheet.get_size(), "columns": self.columns, "frames": self.rects}).encode()
+        def write(f):
+            f.write(TextureAtlas.HEADER.pack(TextureAtlas.MAGIC, TextureAtlas.VERSION, len(table)))
+            f.write(table)
+            f.write(b"\0" * (TextureAtlas.pixels(len(table)) - f.tell()))
+            f.write(pygame.image.tobytes(sheet, TextureAtlas.FORMAT))
+        replaceFile(self.path, write)
+
+    def cell(self, i, size):
+        return ((i % self.columns) * size[0], (i // self.columns) * size[1], size[0], size[1])
+
+    def scale(self, sheet, size):
+        # Frame by frame, scaling the whole sheet would blend neighbouring frames into each other
+        rows = (len(self.rects) + self.columns - 1) // self.columns
+        scaled = pygame.Surface((self.columns * size[0], rows * size[1]), pygame.SRCALPHA, sheet)
+        for i, rect in enumerate(self.rects):
+            pygame.transform.smoothscale(sheet.subsurface(rect), size, scaled.subsurface(self.cell(i, size)))
+        return scaled
+
+    def frames(self, size=None):
+        if size == None:
+            sheet = Texture.cache.get(self.path)
+            rects = self.rects
+        else:
+            size = (int(size[0]), int(size[1]))
+            sheet = Texture.cache.get(self.path, None, size, self)
+            rects = [self.cell(i, size) for i in range(len(self.rects))]
+        views = self.views.get(size)
+        if views == None or views[0] is not sheet:
+            views = (sheet, [sheet.subsurface(rect) for rect in rects])
+            self.views[size] = views
+        return views[1]
+
 class Texture:
+    cache = TextureCache(Constants.TEXTURE_CACHE_BUDGET)
+
     def __init__(self, filename):
-        self.backupSurface = self.surface = pygame.image.load(filename).convert_alpha()
+        self.filename = filename
+        self.backupSurface = self.surface = Texture.cache.get(filename)
 
     def scaleTo(self, size):
-        self.surface = pygame.transform.smoothscale(self.backupSurface, size)
+        self.surface = Texture.cache.get(self.filename, None, size)
 
     def update(self):
         pass
@@ -21,32 +417,28 @@ class AnimatedTexture(Texture):
     def __init__(self, filename, numFrames, loop, speed, start=0):
         self.currentFrame = start
         self.speed = speed
-        self.surfaces = []
-        self.backupSurfaces = []
         self.done = False
         self.loop = loop
-        name, ext = os.path.splitext(filename)
-        for i in range(numFrames):
-            s = pygame.image.load(name + "-" + str(i) + ext).convert_alpha()
-            self.backupSurfaces.append(s)
-            self.surfaces.append(s)
+        self.filename = filename
+        self.atlas = TextureAtlas.get(filename, numFrames)
+        self.surfaces = self.atlas.frames()
         self.start(start)
 
     def scaleTo(self, size):
-        for i in range(len(self.backupSurfaces)):
-            self.surfaces[i] = pygame.transform.smoothscale(self.backupSurfaces[i], size)
+        self.surfaces = self.atlas.frames(size)
         self.surface = self.surfaces[self.currentFrame]
 
     def start(self, frame = 0):
         self.currentFrame = frame
+        self.done = False
         self.surface = self.surfaces[self.currentFrame]
-        self.startTime = time.time()
+        self.startTime = gameClock.now()
 
     def update(self):
         if self.done or self.speed == -1:
             return
 
-        if (time.time() - self.startTime) >= self.speed:
+        if (gameClock.now() - self.startTime) >= self.speed:
             self.advanceFrame()
     
     def advanceFrame(self):
@@ -108,10 +500,196 @@ class CollisionSolver:
         if y1 < y2 or (y1 + h1) > (y2 + h2):
             return True
     
-        return False    
-        
-    
+        return False
+
+
+class SpatialGrid:
+    # Uniform grid broad phase. Cells are cellHeight tall in world y and one
+    # column wide in x, so candidate pairs only come from nearby objects.
+    def __init__(self, originX, columnWidth, cellHeight):
+        self.originX = originX
+        self.columnWidth = columnWidth
+        self.cellHeight = cellHeight
+        self.clear()
+
+    def clear(self):
+        self.cells = dict()
+        self.items = []
+        self.active = []
+        self.unbounded = []
+        self.pairsTested = 0
+
+    def insert(self, obj, passive=False):
+        # Passive objects (traffic) only pair with active ones
+        order = len(self.items)
+        self.items.append(obj)
+        if obj.collisionType == CollisionSolver.NONE:
+            return
+        if obj.collisionType == CollisionSolver.INVERTED_BOX:
+            # Inverted boxes collide with everything outside them, so they can't be bucketed
+            if not passive:
+                self.unbounded.append(order)
+            return
+        if not passive:
+            self.active.append(order)
+        x0 = int((obj.x - self.originX) // self.columnWidth)
+        x1 = int((obj.x + obj.w - self.originX) // self.columnWidth)
+        y0 = int(obj.y // self.cellHeight)
+        y1 = int((obj.y + obj.h) // self.cellHeight)
+        entry = (order, passive)
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                key = (cx, cy)
+                cell = self.cells.get(key)
+                if cell is None:
+                    self.cells[key] = [entry]
+                else:
+                    cell.append(entry)
+
+    def candidatePairs(self):
+        pairs = set()
+        for cell in self.cells.values():
+            n = len(cell)
+            if n < 2:
+                continue
+            for i in range(n):
+                a, aPassive = cell[i]
+                for j in range(i + 1, n):
+                    b, bPassive = cell[j]
+                    if aPassive and bPassive:
+                        continue
+                    if a < b:
+                        pairs.add((a, b))
+                    else:
+                        pairs.add((b, a))
+        for a in self.unbounded:
+            for b in self.active:
+                pairs.add((a, b) if a < b else (b, a))
+        # Keep the order of the old all-pairs loop so hit() side effects replay the same way
+        pairs = sorted(pairs)
+        self.pairsTested = len(pairs)
+        items = self.items
+        return [(items[a], items[b]) for a, b in pairs]
+
+
+class EntityPool:
+    # Free list of dead entities. acquire() hands one back reset in place
+    # through its reset() method, or builds a new one when the pool is empty.
+    def __init__(self, factory, enabled=True):
+        self.factory = factory
+        self.enabled = enabled
+        self.free = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, *args):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args)
+            self.reused += 1
+            return obj
+        self.created += 1
+        return self.factory(*args)
+
+    def release(self, obj):
+        if self.enabled:
+            self.free.append(obj)
+
+
+class EntityRegistry:
+    # Live entities in dense per-view lists. Removing one moves the last entry
+    # of each of its views into its place, so views are never copied or
+    # searched. A handle is a slot index tagged with the slot's generation and
+    # stops resolving once its entity is gone, even after the slot is reused.
+    # destroy() only marks an entity, flush() removes them at the end of the frame.
+    INDEX_BITS = 24
+    INDEX_MASK = (1 << INDEX_BITS) - 1
+
+    def __init__(self, views):
+        self.views = dict((name, []) for name in views)
+        self.entities = []
+        self.generations = []
+        self.positions = []
+        self.free = []
+        self.doomed = []
+
+    def view(self, name):
+        return self.views[name]
+
+    def add(self, entity, views):
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.entities)
+            self.entities.append(None)
+            self.generations.append(0)
+            self.positions.append(None)
+        positions = dict()
+        for name in views:
+            view = self.views[name]
+            positions[name] = len(view)
+            view.append(entity)
+        self.entities[slot] = entity
+        self.positions[slot] = positions
+        entity.handle = self.generations[slot] << EntityRegistry.INDEX_BITS | slot
+        return entity.handle
+
+    def get(self, handle):
+        slot = handle & EntityRegistry.INDEX_MASK
+        if slot < len(self.entities) and self.generations[slot] == handle >> EntityRegistry.INDEX_BITS:
+            return self.entities[slot]
+        return None
+
+    def destroy(self, entity):
+        if not entity.dead:
+            entity.dead = True
+            self.doomed.append(entity)
+
+    def remove(self, entity):
+        slot = entity.handle & EntityRegistry.INDEX_MASK
+        if self.entities[slot] is not entity:
+            return
+        for name, position in self.positions[slot].items():
+            view = self.views[name]
+            last = view.pop()
+            if last is not entity:
+                view[position] = last
+                self.positions[last.handle & EntityRegistry.INDEX_MASK][name] = position
+        self.entities[slot] = None
+        self.positions[slot] = None
+        self.generations[slot] += 1
+        self.free.append(slot)
+
+    def flush(self):
+        # Removes everything destroyed this frame and returns it
+        if not self.doomed:
+            return ()
+        doomed = self.doomed
+        self.doomed = []
+        for entity in doomed:
+            self.remove(entity)
+        return doomed
+
+    def clear(self):
+        # Removes every entity and returns them
+        entities = [e for e in self.entities if e is not None]
+        for view in self.views.values():
+            del view[:]
+        for slot in range(len(self.entities)):
+            if self.entities[slot] is not None:
+                self.entities[slot] = None
+                self.positions[slot] = None
+                self.generations[slot] += 1
+                self.free.append(slot)
+        self.doomed = []
+        return entities
+
+
 class Sprite:
+    __slots__ = ("x", "y", "w", "h", "texture", "size")
+    # Render queue layer, higher layers are drawn on top
+    layer = 0
+
     def __init__(self, texture, pos, size):
         self.x, self.y = pos
         self.w, self.h = size
@@ -123,16 +701,61 @@ class Sprite:
         pass
 
     def display(self, gui):
-        gui.blitSurface(self.texture.surface, (self.x, self.y))
+        gui.submit(self.texture.surface, (self.x, self.y), self.layer)
+
+class GlyphAtlas:
+    # Every character is rendered once, text is assembled from the cached glyphs
+    def __init__(self, font, color, chars):
+        self.font = font
+        self.glyphs = dict((c, font.render(c, 1, color)) for c in chars)
+        self.height = max(glyph.get_height() for glyph in self.glyphs.values())
+
+
+class GlyphLabel:
+    # A line of text built from an atlas. Only the characters that changed since
+    # the last setText are redrawn, the whole surface only when the layout changes.
+    def __init__(self, atlas):
+        self.atlas = atlas
+        self.text = None
+        self.widths = None
+        self.offsets = []
+        self.surface = None
+        self.redraws = 0
+
+    def setText(self, text):
+        if text == self.text:
+            return
+        glyphs = self.atlas.glyphs
+        widths = [glyphs[c].get_width() for c in text]
+        if widths != self.widths:
+            # Lay the glyphs out on the font's advances so the result matches rendering the whole string
+            font = self.atlas.font
+            self.offsets = [font.size(text[:i])[0] for i in range(len(text) + 1)]
+            self.surface = pygame.Surface((max(self.offsets[-1], 1), self.atlas.height), pygame.SRCALPHA)
+            changed = range(len(text))
+        else:
+            changed = [i for i in range(len(text)) if text[i] != self.text[i]]
+        for i in changed:
+            x = self.offsets[i]
+            self.surface.fill((0, 0, 0, 0), (x, 0, self.offsets[i + 1] - x, self.atlas.height))
+            # Max against the cleared pixels copies the glyph including its alpha
+            self.surface.blit(glyphs[text[i]], (x, 0), special_flags=pygame.BLEND_RGBA_MAX)
+        self.redraws += len(changed)
+        self.text = text
+        self.widths = widths
+
 
 class Score(Sprite):
     def __init__(self):
         self.value = 0
-        self.font = pygame.font.SysFont("monospace", 30)
-        self.msgFont = pygame.font.SysFont("arial", 80)
+        self.font = loadFont("monospace", 30)
+        self.msgFont = loadFont("arial", 80)
         self.changeScore(0)
         self.timerStarted = False
-        self.countdownLabel = self.msgFont.render("", 1,(255,0,0))
+        self.timeLabel = GlyphLabel(GlyphAtlas(self.font, (0, 0, 0), "0123456789:."))
+        self.countdownText = None
+        self.countDown("")
+        self.placingText = None
         self.displayplacement("")
         self.timerStopped = False
     
@@ -141,18 +764,27 @@ class Score(Sprite):
         self.scoreLabel = self.font.render(str(self.value) + "(+" + str(change) + ")", 1, (255,255,255))
     
     def displayplacement(self,placement):
+        # Labels are only rendered again when their text changes
+        if placement == self.placingText:
+            return
+        self.placingText = placement
         self.placingLabel = self.font.render(str(placement),1,(255,255,0))
                                              
-    def display(self, gui):
-
-        gui.screen.blit(self.placingLabel,(gui.w - self.placingLabel.get_rect().width,gui.h-self.placingLabel.get_rect().height))
+    def display(self, gui, now=None):
+        if now == None:
+            now = gameClock.now()
+        gui.blitOverlay(self.placingLabel,(gui.w - self.placingLabel.get_rect().width,gui.h-self.placingLabel.get_rect().height))
         #gui.screen.blit(self.scoreLabel, (0, 0))
-        gui.screen.blit(self.countdownLabel,(gui.w/2 - self.countdownLabel.get_rect().width/2, gui.h/2 - self.countdownLabel.get_rect().height/2))
+        if self.countdownText:
+            gui.blitOverlay(self.countdownLabel,(gui.w/2 - self.countdownLabel.get_rect().width/2, gui.h/2 - self.countdownLabel.get_rect().height/2))
         if self.timerStarted:
             if not self.timerStopped:
-                self.timeLabel = self.font.render(self.secondsToStr(time.time() - self.startTime), 1, (0, 0, 0))
-            gui.screen.blit(self.timeLabel, (0, 0))
+                self.timeLabel.setText(self.secondsToStr(now - self.startTime))
+            gui.blitOverlay(self.timeLabel.surface, (0, 0))
     def countDown(self, countdown):
+        if countdown == self.countdownText:
+            return
+        self.countdownText = countdown
         self.countdownLabel = self.msgFont.render(countdown, 1,(255,0,0))
         
     def stopTimer(self):
@@ -164,15 +796,18 @@ class Score(Sprite):
         
         
     def startTimer(self):
-        self.startTime = time.time()
+        self.startTime = gameClock.now()
         self.timerStarted = True
         
-    # From http://code.activestate.com/recipes/511486-secondstostr-hmmsssss-formatting-of-floating-point/
     def secondsToStr(self, t):
-        rediv = lambda ll,b : list(divmod(ll[0],b)) + ll[1:]
-        return "%d:%02d:%02d.%03d" % tuple(reduce(rediv,[[t*1000,],1000,60,60]))    
+        seconds, millis = divmod(int(t * 1000), 1000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return "%d:%02d:%02d.%03d" % (hours, minutes, seconds, millis)
 
 class GameObject(Sprite):
+    __slots__ = ("dead", "engine", "collisionType", "name", "handle")
+
     def __init__(self, engine, texture, pos, size, collisionType, name):
         Sprite.__init__(self, texture, pos, size)
         
@@ -180,89 +815,218 @@ class GameObject(Sprite):
         self.engine = engine
         self.collisionType = collisionType
         self.name = name
+
+    def reset(self, engine, pos):
+        self.x, self.y = pos
+        self.dead = False
+        self.engine = engine
     
     def update(self):
         self.texture.update()
         
     def explode(self, size):
-        self.engine.objects.append(Explosion( self.engine, (self.x + self.w / 2 - size / 2, self.y + self.h / 2 - size / 2), (size, size) ) )
-        self.dead = True
+        explosion = self.engine.explosionPool.acquire( self.engine, (self.x + self.w / 2 - size / 2, self.y + self.h / 2 - size / 2), (size, size) )
+        self.engine.entities.add(explosion, ("objects", "effects"))
+        self.engine.traffic.add(explosion)
+        self.engine.entities.destroy(self)
     
     def hit(self, other):
         pass    
     
 class Explosion(GameObject):
+    __slots__ = ()
+    layer = 1
+
     def __init__(self, engine, pos, size):
         GameObject.__init__(self, engine, AnimatedTexture("data/explode-alpha/explode-alpha.png", 30, False, .1), pos, size, CollisionSolver.BOX, "Explosion")
+        self.playSound()
+
+    def reset(self, engine, pos, size):
+        GameObject.reset(self, engine, pos)
+        if size != self.size:
+            self.w, self.h = size
+            self.size = size
+            self.texture.scaleTo(size)
+        self.texture.start()
+        self.playSound()
+
+    def playSound(self):
         if self.engine.camera.canSee((self.x,self.y),(self.w,self.h)) == True:
-            self.engine.soundManager.getSound(Constants.EXPLOSION_SOUND).play()
-            self.engine.soundManager.getSound(Constants.EXPLOSION_SOUND).fadeout(1500)
+            self.engine.soundManager.play(Constants.EXPLOSION_SOUND, fadeout=1500)
     def update(self):
         self.texture.update()
+        if self.engine.quality >= QualityGovernor.FAST_EXPLOSIONS:
+            # Every other animation frame is dropped, so explosions are gone sooner
+            self.texture.update()
         if self.texture.done:
-            self.dead = True
+            self.engine.entities.destroy(self)
 
-class Sensor(GameObject):
-    def __init__(self, engine, pos, size):
-        GameObject.__init__(self, engine, Texture("data/sensor.png"), pos, size, CollisionSolver.NONE, "Sensor")
-    
-    def update(self):
-        pass
-    
-    def hasPassed(self, obj):
-        return obj.y < self.y
 
 
-class Start(GameObject):
-    def __init__(self, engine, pos, size):
-        GameObject.__init__(self, engine, Texture("data/start.png"), pos, size, CollisionSolver.NONE, "Start")
+class CarStore:
+    # Kinematics of every car as one array per field, so a whole frame of
+    # moving, friction, acceleration and lane changes is a few numpy passes.
+    # Car objects only keep the index of their row.
+    FLOATS = ("x", "y", "xv", "yv", "acceleration", "maxSpeed", "lastCollisionTime", "collisionDelay", "xTarget")
+    BOOLS = ("moving", "retires", "alive")
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        for name in CarStore.FLOATS:
+            setattr(self, name, numpy.zeros(capacity))
+        for name in CarStore.BOOLS:
+            setattr(self, name, numpy.zeros(capacity, dtype=bool))
+        self.owners = [None] * capacity
+        self.free = []
+        self.count = 0
+        self.live = 0
+
+    def grow(self):
+        self.capacity *= 2
+        for name in CarStore.FLOATS + CarStore.BOOLS:
+            old = getattr(self, name)
+            new = numpy.zeros(self.capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.owners.extend([None] * (self.capacity - len(self.owners)))
+
+    def add(self, car, retires=False):
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.count == self.capacity:
+                self.grow()
+            row = self.count
+            self.count += 1
+        self.owners[row] = car
+        self.alive[row] = True
+        self.retires[row] = retires
+        car.store = self
+        car.row = row
+        self.live += 1
+
+    def remove(self, car):
+        row = car.row
+        if self.owners[row] is not car:
+            return
+        self.owners[row] = None
+        self.alive[row] = False
+        self.moving[row] = False
+        self.retires[row] = False
+        self.xv[row] = self.yv[row] = self.acceleration[row] = 0
+        self.free.append(row)
+        self.live -= 1
+
+    def visibleRows(self, top, bottom, h):
+        # Rows of the cars overlapping the world y range top to bottom
+        y = self.y[:self.count]
+        return numpy.flatnonzero(self.alive[:self.count] & (y < bottom) & (y + h > top))
+
+    def integrate(self, now, retireY):
+        # Car.update, slow, accelerate and moveToLane for every car at once.
+        # Returns the rows that finished a lane change and the rows of
+        # retiring cars that fell behind retireY.
+        n = self.count
+        x, y, xv, yv = self.x[:n], self.y[:n], self.xv[:n], self.yv[:n]
+        maxSpeed = self.maxSpeed[:n]
+        changed = numpy.flatnonzero(self.alive[:n] & ((xv != 0) | (yv != 0)))
+        x += xv
+        y += yv
+        slowing = now < self.lastCollisionTime[:n] + self.collisionDelay[:n]
+        numpy.multiply(yv, Constants.FRICTION, out=yv, where=slowing)
+        yv += self.acceleration[:n]
+        numpy.minimum(yv, maxSpeed, out=yv)
+        numpy.maximum(yv, -maxSpeed, out=yv)
+        moving = self.moving[:n]
+        xTarget = self.xTarget[:n]
+        arrived = moving & (((xv > 0) & (x >= xTarget)) | ((xv < 0) & (x <= xTarget)))
+        x[arrived] = xTarget[arrived]
+        xv[arrived] = 0
+        moving[arrived] = False
+        owners = self.owners
+        for row, cx, cy in zip(changed.tolist(), x[changed].tolist(), y[changed].tolist()):
+            car = owners[row]
+            car.storedX = cx
+            car.storedY = cy
+        retired = self.retires[:n] & self.alive[:n] & (y > retireY)
+        return numpy.flatnonzero(arrived), numpy.flatnonzero(retired)
 
-class Finish(GameObject):
-    def __init__(self, engine, pos, size):
-        GameObject.__init__(self, engine, Texture("data/finish.png"), pos, size, CollisionSolver.NONE, "Finish")
-    
+
+def carField(name):
+    def get(self):
+        return getattr(self.store, name).item(self.row)
+    def set(self, value):
+        getattr(self.store, name)[self.row] = value
+    return property(get, set)
+
+
+def mirroredCarField(name, mirror):
+    # x and y are read all over every frame, so they are also kept as plain
+    # floats on the car, which CarStore.integrate updates for the rows it moved
+    def set(self, value):
+        value = float(value)
+        getattr(self.store, name)[self.row] = value
+        setattr(self, mirror, value)
+    return property(operator.attrgetter(mirror), set)
 
 
 class Car(GameObject):
+    __slots__ = ("store", "row", "turnSpeed", "storedX", "storedY")
+
+    x = mirroredCarField("x", "storedX")
+    y = mirroredCarField("y", "storedY")
+    xv = carField("xv")
+    yv = carField("yv")
+    acceleration = carField("acceleration")
+    maxSpeed = carField("maxSpeed")
+    lastCollisionTime = carField("lastCollisionTime")
+    collisionDelay = carField("collisionDelay")
+    xTarget = carField("xTarget")
+    moving = carField("moving")
+
     def __init__(self, engine, texture, pos, a, v, vt, name):
+        engine.carStore.add(self, name == "NormalCar")
         self.xv, self.yv = 0, 0
         self.acceleration = a
         self.maxSpeed = v
         self.turnSpeed = vt
         self.collisionDelay = .5
-        self.lastCollisionTime = time.time() - self.collisionDelay
+        self.lastCollisionTime = gameClock.now() - self.collisionDelay
+        self.moving = False
         GameObject.__init__(self, engine, texture, pos, Constants.CAR_SIZE, CollisionSolver.BOX, name) 
+
+    def reset(self, engine, pos, a, v):
+        engine.carStore.add(self, self.name == "NormalCar")
+        self.xv, self.yv = 0, 0
+        self.acceleration = a
+        self.maxSpeed = v
+        self.collisionDelay = .5
+        self.lastCollisionTime = gameClock.now() - self.collisionDelay
+        self.moving = False
+        GameObject.reset(self, engine, pos)
         
     def hit(self, other):
         pass
     
     def update(self):
-        self.x += self.xv
-        self.y += self.yv
-        self.slow()
+        # Moving, friction and acceleration happen in CarStore.integrate
         self.act()
         
     def act(self):
-        self.accelerate()
-        
-    def slow(self):
-        if time.time() < self.lastCollisionTime + self.collisionDelay:
-            self.yv *= Constants.FRICTION
-        
-    def accelerate(self):
-        self.yv += self.acceleration
-        if self.yv > self.maxSpeed:
-            self.yv = self.maxSpeed
-        elif self.yv < -self.maxSpeed:
-            self.yv = -self.maxSpeed
+        pass
+
+    def arrive(self):
+        # Called when CarStore.integrate finishes a lane change
+        pass
 
 class AICar(Car):
+    __slots__ = ("lanes",)
+
     def __init__(self, engine, pos):
-        texture = AnimatedTexture(Constants.AI_CAR_IMAGE, Constants.NUM_AI_CARS, loop=False, speed=-1, start=random.randrange(Constants.NUM_AI_CARS))
+        texture = AnimatedTexture(Constants.AI_CAR_IMAGE, Constants.NUM_AI_CARS, loop=False, speed=-1, start=engine.rng.randrange(Constants.NUM_AI_CARS))
         a = Constants.AI_CAR_ACCELERATION
         v = Constants.AI_CAR_SPEED
         vt = Constants.AI_CAR_TURNSPEED
-        self.moving = False
         self.lanes = []
         
         Car.__init__(self, engine, texture, pos, a, v, vt, "AICar")
@@ -271,57 +1035,36 @@ class AICar(Car):
             if lane.isObjectIn(self):
                 self.lanes.append(lane)      
         
+    def update(self):
+        # Lane decisions are made when Game.aiScheduler gets to this car
+        pass
+
     def act(self):
-        self.accelerate()
-        if self.moving:
-            self.moveToClearLane()
-        else:
+        if not self.moving:
             self.chooseLane()
     
-    def moveToClearLane(self):
-        if self.xv == 0 or not self.moving:
-            return
-        
-        if self.xv > 0 and self.x >= self.xTarget:
-            self.x = self.xTarget
-            self.xv = 0
-            self.moving = False
-            del self.lanes[0]
-        elif self.xv < 0 and self.x <= self.xTarget:
-            self.x = self.xTarget
-            self.xv = 0
-            self.moving = False
-            del self.lanes[0]
+    def arrive(self):
+        del self.lanes[0]
             
     def chooseLane(self):
         currentLane = self.engine.road.getLaneObjectIsIn(self)
         lanes = [currentLane] + self.engine.road.getAdjacentLanes(currentLane)
         dists = []
-        for i in range(len(lanes)):
-            lane = lanes[i]
-            dists.append(300)
-            for o in self.engine.objects + self.engine.normalCars:
+        for lane in lanes:
+            dist = 300
+            for o in self.engine.aiCars:
                 if o is self:
                     continue
-               
-                
-                dist = self.y - o.y
-                if dist < -self.w * 2:
-                    continue
-                if o.name == "AICar" and dist < self.w:
-                    #print ("Found AICar")
-                    if lane in o.lanes:
-                        #print ("Already reserved lane")
-                        dists[i] = -1
-                        break
-                    else:
-                        #print ("Lane is free")
-                        pass
-                        
-                if not lane.isObjectIn(o):
-                    continue                
-                if dist < dists[i]:
-                    dists[i] = dist
+                d = self.y - o.y
+                if d >= -self.w * 2 and d < self.w and lane in o.lanes:
+                    # Another AI car already reserved this lane
+                    dist = -1
+                    break
+            else:
+                o = self.engine.traffic.nearestAhead(lane, self.y + self.w * 2, self)
+                if o is not None and self.y - o.y < dist:
+                    dist = self.y - o.y
+            dists.append(dist)
         
         target = lanes[dists.index(max(dists))]
         self.lanes.append(target)
@@ -332,70 +1075,163 @@ class AICar(Car):
         
     def hit(self, other):
         if other.name == "NormalCar":
-            self.lastCollisionTime = time.time()
+            self.lastCollisionTime = gameClock.now()
         
 
+class AIScheduler:
+    # Runs AICar decisions every interval updates instead of every frame,
+    # with the cars spread evenly over those updates. Decisions that don't
+    # fit into the frame's budget wait at the front of the queue for the
+    # next frame. Without a timer every decision is charged a fixed cost, so
+    # what gets deferred doesn't depend on how fast the machine is. A limit
+    # runs that many decisions instead, to replay a recorded frame.
+    def __init__(self, cars, interval, budget, timer=None, cost=0):
+        self.interval = max(1, interval)
+        self.budget = budget / 1000000.0
+        self.timer = timer
+        self.cost = cost / 1000000.0
+        self.slots = [[] for i in range(self.interval)]
+        for i, car in enumerate(cars):
+            self.slots[i % self.interval].append(car)
+        self.queue = collections.deque()
+        self.queued = set()
+        self.decisions = 0
+        self.deferred = 0
+        self.latency = 0
+        self.maxLatency = 0
+
+    def run(self, update, limit=None):
+        # Returns the number of decisions made
+        for car in self.slots[update % self.interval]:
+            if car not in self.queued:
+                self.queued.add(car)
+                self.queue.append((car, update))
+        queue = self.queue
+        timer = self.timer
+        start = timer() if timer != None else 0.0
+        spent = 0.0
+        ran = 0
+        # At least the oldest decision runs every frame, so nothing waits forever
+        while queue and (ran < limit if limit != None else ran == 0 or spent < self.budget):
+            car, due = queue.popleft()
+            self.queued.discard(car)
+            if car.dead:
+                continue
+            car.act()
+            ran += 1
+            latency = update - due
+            self.decisions += 1
+            self.latency += latency
+            self.maxLatency = max(self.maxLatency, latency)
+            spent = timer() - start if timer != None else spent + self.cost
+        self.deferred += len(queue)
+        return ran
+
+    def stats(self):
+        return {
+            "decisions": self.decisions,
+            "deferred": self.deferred,
+            "meanLatency": self.latency / float(max(self.decisions, 1)),
+            "maxLatency": self.maxLatency,
+        }
+
+
 class NormalCar(Car):
-    def __init__(self, engine, pos,turnlane):
-        texture = AnimatedTexture(Constants.NORMAL_CAR_IMAGE, Constants.NUM_NORMAL_CARS, loop=False, speed=-1, start=random.randrange(Constants.NUM_NORMAL_CARS))
+    __slots__ = ("turnlane",)
+
+    def __init__(self, engine, pos,turnlane, frame=None):
+        if frame == None:
+            frame = engine.rng.randrange(Constants.NUM_NORMAL_CARS)
+        texture = AnimatedTexture(Constants.NORMAL_CAR_IMAGE, Constants.NUM_NORMAL_CARS, loop=False, speed=-1, start=frame)
         a = Constants.NORMAL_CAR_ACCELERATION
         v = Constants.NORMAL_CAR_SPEED
         vt = Constants.NORMAL_CAR_TURNSPEED
         self.turnlane = turnlane
-        self.moving = False
         #print ("Constructor: " + str(self.turnlane))
         Car.__init__(self, engine, texture, pos, a, v, vt, "NormalCar")
+
+    def reset(self, engine, pos, turnlane, frame=None):
+        if frame == None:
+            frame = engine.rng.randrange(Constants.NUM_NORMAL_CARS)
+        self.texture.start(frame)
+        self.turnlane = turnlane
+        Car.reset(self, engine, pos, Constants.NORMAL_CAR_ACCELERATION, Constants.NORMAL_CAR_SPEED)
         
     def hit(self, other):
         if other.name == "PlayerCar" or other.name == "AICar":
             self.explode(300)            
             
-    def act(self):
-        self.accelerate()
-        if self.y > -self.engine.camera.yOffset + self.engine.camera.h + Constants.CAR_SIZE[1]:
-            self.dead = True
-        self.moveToLane()
-
     def moveNormalCar(self):
+        # True when this starts a lane change
         if self.turnlane == None:
-            return
+            return False
         if self.moving or self.turnlane.isObjectIn(self):
-            return
-        self.engine.soundManager.getSound(Constants.TIRE_SKID).play()
-        self.engine.soundManager.getSound(Constants.TIRE_SKID).fadeout(500)
+            return False
+        self.engine.soundManager.play(Constants.TIRE_SKID, fadeout=500)
+        self.engine.traffic.track(self)
         self.xv = math.copysign(Constants.NORMAL_CAR_TURNSPEED,self.turnlane.x - self.x)
         #print("xv: " + str(self.xv))
         self.moving = True
         self.xTarget=self.turnlane.center - self.w/2
         #print("xTarget: " + str(self.xTarget))
+        return True
+
 
-    def moveToLane(self):
-        if self.xv == 0 or not self.moving:
-            return
-        #print ("moving")
-        if self.xv > 0 and self.x >= self.xTarget:
-            self.x = self.xTarget
-            self.xv = 0
-            self.moving = False
-
-        elif self.xv < 0 and self.x <= self.xTarget:
-            self.x = self.xTarget
-            self.xv = 0
-            self.moving = False
-    
+
+def coastDistance(v0, a, maxSpeed, steps):
+    # How far CarStore.integrate moves an undisturbed car in steps frames,
+    # starting at velocity v0 with constant acceleration a
+    if a == 0:
+        return steps * v0
+    if a > 0:
+        return -coastDistance(-v0, -a, maxSpeed, steps)
+    free = min(steps, max(0, int(math.ceil((maxSpeed + v0) / -a))))
+    return free * v0 + a * free * (free - 1) / 2 - (steps - free) * maxSpeed
+
+def coastVelocity(v0, a, maxSpeed, steps):
+    return min(max(v0 + steps * a, -maxSpeed), maxSpeed)
+
+class SleepingCar:
+    # A NormalCar outside the activation window. Nothing touches it per frame,
+    # its position follows from where and when it was spawned until the
+    # camera gets close enough to wake it into a real NormalCar.
+    __slots__ = ("engine", "lane", "turnlane", "frame", "spawnY", "spawnUpdate", "key", "car")
+
+    def __init__(self, engine, lane, yPos, turnlane):
+        self.engine = engine
+        self.lane = lane
+        self.turnlane = turnlane
+        # Drawn now so the random sequence is the same as for an awake car
+        self.frame = engine.rng.randrange(Constants.NUM_NORMAL_CARS)
+        self.spawnY = yPos - Constants.CAR_SIZE[1] / 2
+        self.spawnUpdate = engine.updates
+        # Position in traffic space, where undisturbed traffic stands still
+        self.key = self.spawnY - engine.trafficOffset
+        self.car = None
+
+    @property
+    def y(self):
+        steps = self.engine.updates - self.spawnUpdate
+        return self.spawnY + coastDistance(0, Constants.NORMAL_CAR_ACCELERATION, Constants.NORMAL_CAR_SPEED, steps)
+
+    def velocity(self):
+        steps = self.engine.updates - self.spawnUpdate
+        return coastVelocity(0, Constants.NORMAL_CAR_ACCELERATION, Constants.NORMAL_CAR_SPEED, steps)
 
 class PlayerCar(Car):
+    __slots__ = ()
+
     def __init__(self, engine, pos):
         texture = Texture(Constants.PLAYER_CAR_IMAGE)
         a = Constants.PLAYER_CAR_ACCELERATION
         v = Constants.PLAYER_CAR_SPEED
         vt = Constants.PLAYER_CAR_TURNSPEED
         Car.__init__(self, engine, texture, pos, a, v, vt, "PlayerCar")
-        self.engine.soundManager.getSound(Constants.ENGINE_SOUND).play(-1)
+        self.engine.soundManager.play(Constants.ENGINE_SOUND, loops=-1)
     
     def hit(self, other):
         if other.name == "Road" or other.name == "NormalCar":
-            self.lastCollisionTime = time.time()
+            self.lastCollisionTime = gameClock.now()
         if other.name == "AICar":
             # Try self.x
             self.x -= self.xv
@@ -445,21 +1281,46 @@ class Road(GameObject):
         self.dead = False
         self.engine = engine
         self.name = "Road"
-        self.s1 = Sprite(Texture(Constants.BACKGROUND_TEXTURE), (0, 0), (self.engine.gui.w, self.engine.gui.h) )
-        self.s2 = Sprite(Texture(Constants.BACKGROUND_TEXTURE), (0, -self.engine.gui.h), (self.engine.gui.w, self.engine.gui.h) )
-        
+        # Static road content is composited into a strip two screens tall that
+        # is rebuilt only when the camera crosses into the next screen, so the
+        # road costs one blit per frame however many decals the track has
+        self.tile = Texture(Constants.BACKGROUND_TEXTURE)
+        self.tile.scaleTo((engine.gui.w, engine.gui.h))
+        self.decals = []
+        self.strip = pygame.Surface((engine.gui.w, engine.gui.h * 2)).convert()
+        self.segment = None
+        self.stripBuilds = 0
+
+    def addDecal(self, filename, pos, size):
+        texture = Texture(filename)
+        texture.scaleTo(size)
+        self.decals.append((pos[1], pos[1] + size[1], pos[0], texture.surface))
+        self.decals.sort(key=operator.itemgetter(0))
+        self.segment = None
+
     def update(self):
-        self.s1.update()
-        self.s2.update()
-        
-        yDiff = self.s1.y + self.s1.h + self.engine.camera.yOffset
-        if yDiff >= 2 * self.engine.gui.h:
-            self.s1.y -= self.engine.gui.h * 2
-            self.s1, self.s2 = self.s2, self.s1     
-        
+        if self.engine.endless:
+            # Keep the road's collision box ahead of the camera
+            self.h = max(self.h, self.engine.camera.yOffset + Constants.TRAFFIC_LOOKAHEAD)
+            self.y = -self.h
+
+    def buildStrip(self, segment):
+        h = self.engine.gui.h
+        top = segment * h
+        self.strip.fill((0, 0, 0))
+        self.strip.blit(self.tile.surface, (0, 0))
+        self.strip.blit(self.tile.surface, (0, h))
+        for y1, y2, x, surface in self.decals:
+            if y1 < top + 2 * h and y2 > top:
+                self.strip.blit(surface, (x, y1 - top))
+        self.segment = segment
+        self.stripBuilds += 1
+
     def display(self, gui):
-        self.s1.display(gui)
-        self.s2.display(gui)
+        segment = int(math.floor(-gui.camera.yOffset / gui.h))
+        if segment != self.segment:
+            self.buildStrip(segment)
+        gui.blitStatic(self.strip, (0, segment * gui.h))
         
     def getAdjacentLanes(self, lane):
         re = []
@@ -478,6 +1339,174 @@ class Road(GameObject):
 
 
 
+class TrafficIndex(object):
+    # Cars bucketed per lane and kept sorted by y so lane queries are a bisect
+    # instead of a scan over every object. Buckets are re-sorted lazily, only
+    # for lanes that are queried after cars have moved.
+    # Sleeping cars never change order, they are kept per lane in spawn order
+    # with their traffic space key and are never re-sorted. Woken ones are
+    # skipped and dropped from the front as the camera reaches them.
+    def __init__(self, lanes, engine):
+        self.lanes = lanes
+        self.engine = engine
+        self.clearSleepers()
+        self.buckets = dict((lane, []) for lane in lanes)
+        self.keys = dict((lane, []) for lane in lanes)
+        self.stale = set(lanes)
+        self.laneOf = dict()
+        self.movers = set()
+        self.turning = []
+        self.turningKeys = []
+        self.turningStale = False
+
+    def add(self, obj, mobile=False):
+        lanes = [lane for lane in self.lanes if lane.isObjectIn(obj)]
+        self.laneOf[obj] = lanes
+        for lane in lanes:
+            self.buckets[lane].append(obj)
+            self.stale.add(lane)
+        if mobile:
+            self.movers.add(obj)
+        if obj.name == "NormalCar" and obj.turnlane != None:
+            self.turning.append(obj)
+            self.turningStale = True
+
+    def addSleeper(self, sleeper):
+        self.sleepers[sleeper.lane].append(sleeper)
+        if sleeper.turnlane != None:
+            self.turningSleepers.append(sleeper)
+
+    def clearSleepers(self):
+        self.sleepers = dict((lane, SleeperList()) for lane in self.lanes)
+        self.turningSleepers = SleeperList()
+
+    def wake(self, sleeper):
+        self.sleepers[sleeper.lane].advance()
+        if sleeper.turnlane != None:
+            self.turningSleepers.advance()
+
+    def remove(self, obj):
+        self.removeAll((obj,))
+
+    def removeAll(self, objs):
+        # Every bucket that lost objects is filtered once, however many died
+        gone = set()
+        lanes = set()
+        turning = False
+        for obj in objs:
+            objLanes = self.laneOf.pop(obj, None)
+            if objLanes is None:
+                continue
+            gone.add(obj)
+            lanes.update(objLanes)
+            self.movers.discard(obj)
+            if obj.name == "NormalCar" and obj.turnlane != None:
+                turning = True
+        for lane in lanes:
+            bucket = self.buckets[lane]
+            bucket[:] = [o for o in bucket if not o in gone]
+            self.stale.add(lane)
+        if turning:
+            self.turning = [c for c in self.turning if not c in gone]
+            self.turningStale = True
+
+    def track(self, obj):
+        # Start following an object that is about to change lanes
+        if obj in self.laneOf:
+            self.movers.add(obj)
+
+    def update(self):
+        # Called once per frame after everything has moved
+        for obj in list(self.movers):
+            lanes = [lane for lane in self.lanes if lane.isObjectIn(obj)]
+            old = self.laneOf[obj]
+            if lanes != old:
+                for lane in old:
+                    if not lane in lanes:
+                        self.buckets[lane].remove(obj)
+                for lane in lanes:
+                    if not lane in old:
+                        self.buckets[lane].append(obj)
+                self.laneOf[obj] = lanes
+            if obj.name == "NormalCar" and not obj.moving:
+                self.movers.discard(obj)
+        self.stale.update(self.lanes)
+        self.turningStale = True
+
+    def refresh(self, lane):
+        bucket = self.buckets[lane]
+        bucket.sort(key=operator.attrgetter("y"))
+        self.keys[lane] = [o.y for o in bucket]
+        self.stale.discard(lane)
+
+    def nearestAhead(self, lane, y, exclude=None):
+        # The object in lane with the largest y that is still <= y
+        if lane in self.stale:
+            self.refresh(lane)
+        bucket = self.buckets[lane]
+        i = bisect.bisect_right(self.keys[lane], y) - 1
+        while i >= 0 and bucket[i] is exclude:
+            i -= 1
+        best = bucket[i] if i >= 0 else None
+        sleeper = self.sleepers[lane].nearestAhead(y, self.engine.trafficOffset)
+        if sleeper != None and (best == None or sleeper.y > best.y):
+            return sleeper
+        return best
+
+    def nearestTurningCar(self, y, minDistance):
+        # The closest NormalCar with a turnlane that is more than minDistance away from y
+        if self.turningStale:
+            self.turning.sort(key=operator.attrgetter("y"))
+            self.turningKeys = [c.y for c in self.turning]
+            self.turningStale = False
+        keys = self.turningKeys
+        best = None
+        i = bisect.bisect_left(keys, y - minDistance) - 1
+        if i >= 0:
+            best = self.turning[i]
+        j = bisect.bisect_right(keys, y + minDistance)
+        if j < len(keys) and (best is None or keys[j] - y < y - best.y):
+            best = self.turning[j]
+        # Sleepers are all far ahead, so only the one nearest to y can beat best
+        sleeper = self.turningSleepers.nearestAhead(y - minDistance, self.engine.trafficOffset)
+        if sleeper != None and (best is None or abs(sleeper.y - y) < abs(best.y - y)):
+            best = sleeper
+        return best
+
+
+class SleeperList:
+    # Sleeping cars in spawn order, which is nearest first. Keys are negated
+    # traffic space positions so they ascend, woken cars are dropped from the
+    # front lazily.
+    def __init__(self):
+        self.items = []
+        self.keys = []
+        self.head = 0
+
+    def append(self, sleeper):
+        self.items.append(sleeper)
+        self.keys.append(-sleeper.key)
+
+    def advance(self):
+        items = self.items
+        while self.head < len(items) and items[self.head].car != None:
+            self.head += 1
+        if self.head > 256 and self.head * 2 > len(items):
+            del items[:self.head]
+            del self.keys[:self.head]
+            self.head = 0
+
+    def nearestAhead(self, y, trafficOffset):
+        # The sleeping car with the largest y that is still <= y
+        items = self.items
+        i = bisect.bisect_left(self.keys, trafficOffset - y, self.head)
+        while i < len(items) and (items[i].car != None or items[i].y > y):
+            i += 1
+        if i == len(items):
+            return None
+        return items[i]
+
+
 class Camera(object):
     def __init__(self, follow, size):
         self.follow = follow
@@ -493,23 +1522,73 @@ class Camera(object):
         self.yOffset = -self.follow.y  + self.h - self.follow.h
         
     def canSee(self, pos, size):
-        y1 = pos[1]
-        h1 = size[1]
-        y2 = -self.yOffset
-        h2 = self.h
-        return y1 < y2 + h2 and h1 + y1 > y2
+        top, bottom = self.interval()
+        return pos[1] < bottom and pos[1] + size[1] > top
+
+    def interval(self):
+        # The world y range on screen
+        return -self.yOffset, -self.yOffset + self.h
             
             
 class SoundManager:
+    # Every sound is loaded up front. Each category plays on its own reserved
+    # mixer channels, a play with every channel busy takes over the one that
+    # started longest ago, and plays past a category's per frame limit are
+    # dropped, so a chain of explosions costs a few channel plays at most.
     def __init__(self):
         pygame.mixer.pre_init()
         pygame.mixer.init()
+        categories = sorted(Constants.SOUND_CHANNELS)
+        reserved = sum(Constants.SOUND_CHANNELS.values())
+        pygame.mixer.set_num_channels(max(pygame.mixer.get_num_channels(), reserved))
+        pygame.mixer.set_reserved(reserved)
+        self.channels = dict()
+        self.started = dict()
+        first = 0
+        for category in categories:
+            count = Constants.SOUND_CHANNELS[category]
+            self.channels[category] = [pygame.mixer.Channel(i) for i in range(first, first + count)]
+            self.started[category] = [0] * count
+            first += count
         self.sounds = dict()
-    
-    def getSound(self, filename):
-        if not filename in self.sounds.keys():
-            self.sounds[filename] = pygame.mixer.Sound(filename)
-        return self.sounds[filename]
+        for filename, category in Constants.SOUND_CATEGORIES.items():
+            sound = assets.sound(filename) if assets != None else None
+            self.sounds[filename] = (sound if sound != None else pygame.mixer.Sound(filename), category)
+        self.playsThisFrame = dict((category, 0) for category in categories)
+        self.plays = 0
+        self.dropped = 0
+        self.stolen = 0
+
+    def beginFrame(self):
+        for category in self.playsThisFrame:
+            self.playsThisFrame[category] = 0
+
+    def play(self, filename, loops=0, fadeout=0):
+        sound, category = self.sounds[filename]
+        if self.playsThisFrame[category] >= Constants.SOUND_PLAYS_PER_FRAME[category]:
+            self.dropped += 1
+            return
+        self.playsThisFrame[category] += 1
+        channels = self.channels[category]
+        started = self.started[category]
+        oldest = 0
+        for i in range(len(channels)):
+            if not channels[i].get_busy():
+                oldest = i
+                break
+            if started[i] < started[oldest]:
+                oldest = i
+        else:
+            self.stolen += 1
+        self.plays += 1
+        started[oldest] = self.plays
+        channel = channels[oldest]
+        channel.play(sound, loops)
+        if fadeout:
+            channel.fadeout(fadeout)
+
+    def stats(self):
+        return {"plays": self.plays, "dropped": self.dropped, "stolen": self.stolen}
 
     def quit(self):
         pygame.mixer.quit()
@@ -527,6 +1606,15 @@ class GUI:
         self.background = pygame.Surface(self.screen.get_size())
         self.background = self.background.convert()
         self.background.fill((0, 0, 0))
+        self.blits = 0
+        self.retained = Constants.RETAINED_RENDERING
+        self.backdrop = pygame.Surface(self.screen.get_size()).convert()
+        self.backdropValid = False
+        self.backdropPending = False
+        self.lastOffset = None
+        self.lastRects = []
+        self.rects = []
+        self.queue = []
 
     def cleanup(self):
         pygame.font.quit()
@@ -535,29 +1623,627 @@ class GUI:
     def setCaption(self, title, icon):
         pygame.display.set_caption(title, icon)
 
-    def beginDraw(self):
-        self.screen.blit(self.background, (0, 0) )
+    def beginDraw(self, camera):
+        self.camera = camera
+        self.blits = 0
+        if not self.retained:
+            self.staticTarget = self.screen
+            self.screen.blit(self.background, (0, 0) )
+            return
+        # Retained mode: while the camera holds still only the rectangles
+        # sprites covered last frame and this frame are redrawn and pushed.
+        offset = (camera.xOffset, camera.yOffset)
+        moved = offset != self.lastOffset
+        self.lastOffset = offset
+        if moved:
+            self.backdropValid = False
+        self.rects = []
+        self.fullRedraw = moved or not self.backdropValid
+        self.backdropPending = False
+        if self.fullRedraw:
+            if moved:
+                self.staticTarget = self.screen
+            else:
+                # The camera stopped, keep the static layer for the frames after this one
+                self.staticTarget = self.backdrop
+                self.backdropPending = True
+            self.staticTarget.blit(self.background, (0, 0) )
+        else:
+            self.staticTarget = None
+            for rect in self.lastRects:
+                self.screen.blit(self.backdrop, rect, rect)
 
     def endDraw(self):
-        pygame.display.flip()
+        if not self.retained:
+            pygame.display.flip()
+            return
+        self.flushBackdrop()
+        if self.fullRedraw:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.lastRects + self.rects)
+        self.lastRects = self.rects
+
+    def flushBackdrop(self):
+        if self.backdropPending:
+            self.screen.blit(self.backdrop, (0, 0))
+            self.backdropPending = False
+            self.backdropValid = True
+
+    def blitStatic(self, surface, pos):
+        # Draws that only change when the camera scrolls, like the road
+        if self.staticTarget != None and self.camera.canSee(pos, surface.get_rect().size):
+            self.blits += 1
+            self.staticTarget.blit(surface, self.camera.applyOffset(pos))
+
+    def submit(self, surface, pos, layer):
+        # Queues a sprite in world coordinates, already culled by the caller
+        camera = self.camera
+        self.queue.append((layer, id(surface), surface, (pos[0] + camera.xOffset, pos[1] + camera.yOffset)))
+
+    def flushQueue(self):
+        # Everything submitted this frame goes out in one blits call, by layer
+        # and grouped by texture within a layer
+        queue = self.queue
+        if not queue:
+            return
+        self.queue = []
+        queue.sort(key=GUI.queueOrder)
+        self.blits += len(queue)
+        if not self.retained:
+            self.screen.blits([(surface, pos) for layer, key, surface, pos in queue], False)
+            return
+        self.flushBackdrop()
+        self.rects.extend(self.screen.blits([(surface, pos) for layer, key, surface, pos in queue]))
+
+    queueOrder = operator.itemgetter(0, 1)
 
-    def blitSurface(self, surface, pos):
-        if self.engine.camera.canSee(pos, surface.get_rect().size):
-            self.screen.blit(surface, self.engine.camera.applyOffset(pos))
+    def blitOverlay(self, surface, pos):
+        # Draws in screen coordinates
+        self.blits += 1
+        if not self.retained:
+            self.screen.blit(surface, pos)
+            return
+        self.flushBackdrop()
+        self.rects.append(self.screen.blit(surface, pos))
         
+class FrameProfiler:
+    # Times the stages of every frame into a fixed-size ring buffer. Each
+    # record is one flat list: frame number, frame start, frame length, then
+    # the offset and length of every stage, then the counters.
+    def __init__(self, stages, counters, size):
+        self.stages = stages
+        self.counters = counters
+        self.stageIndex = dict((name, i) for i, name in enumerate(stages))
+        self.counterIndex = dict((name, i) for i, name in enumerate(counters))
+        self.size = size
+        self.width = 3 + 2 * len(stages) + len(counters)
+        self.records = [[0] * self.width for i in range(size)]
+        self.frame = 0
+        self.current = self.records[0]
+        self.overlay = False
+        self.overlaySurface = None
+        self.font = None
+
+    def beginFrame(self):
+        self.current = self.records[self.frame % self.size]
+        for i in range(self.width):
+            self.current[i] = 0
+        self.current[0] = self.frame
+        self.current[1] = time.perf_counter()
+
+    def measure(self, stage, func):
+        start = time.perf_counter()
+        func()
+        end = time.perf_counter()
+        i = 3 + 2 * self.stageIndex[stage]
+        self.current[i] = start - self.current[1]
+        self.current[i + 1] = end - start
+
+    def setCounter(self, name, value):
+        self.current[3 + 2 * len(self.stages) + self.counterIndex[name]] = value
+
+    def endFrame(self):
+        self.current[2] = time.perf_counter() - self.current[1]
+        self.frame += 1
+
+    def history(self):
+        # Recorded frames, oldest first
+        count = min(self.frame, self.size)
+        return [self.records[i % self.size] for i in range(self.frame - count, self.frame)]
+
+    def summary(self):
+        frames = self.history()
+        rows = []
+        for name in ["frame"] + self.stages:
+            i = 2 if name == "frame" else 4 + 2 * self.stageIndex[name]
+            values = [r[i] for r in frames] or [0]
+            rows.append((name, values[-1] * 1000, sum(values) / len(values) * 1000, max(values) * 1000))
+        return rows
+
+    def toggleOverlay(self):
+        self.overlay = not self.overlay
+        self.overlaySurface = None
+
+    def display(self, gui):
+        if not self.overlay:
+            return
+        if self.overlaySurface == None or self.frame % 30 == 0:
+            if self.font == None:
+                self.font = loadFont("monospace", 14)
+            lines = ["%-13s %6s %6s %6s" % ("ms", "last", "avg", "max")]
+            for name, last, avg, worst in self.summary():
+                lines.append("%-13s %6.2f %6.2f %6.2f" % (name, last, avg, worst))
+            base = 3 + 2 * len(self.stages)
+            for i, name in enumerate(self.counters):
+                lines.append("%-13s %6d" % (name, self.current[base + i]))
+            height = self.font.get_linesize()
+            self.overlaySurface = pygame.Surface((260, height * len(lines) + 4))
+            self.overlaySurface.set_alpha(200)
+            for i, line in enumerate(lines):
+                self.overlaySurface.blit(self.font.render(line, 1, (0, 255, 0)), (2, 2 + i * height))
+        gui.blitOverlay(self.overlaySurface, (0, 40))
+
+    def exportChromeTrace(self, filename):
+        events = []
+        base = 3 + 2 * len(self.stages)
+        for r in self.history():
+            start = r[1] * 1000000
+            events.append({"name": "frame", "ph": "X", "pid": 0, "tid": 0, "ts": start, "dur": r[2] * 1000000, "args": {"frame": r[0]}})
+            for name, i in self.stageIndex.items():
+                if r[4 + 2 * i] > 0:
+                    events.append({"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": start + r[3 + 2 * i] * 1000000, "dur": r[4 + 2 * i] * 1000000})
+            events.append({"name": "counters", "ph": "C", "pid": 0, "tid": 0, "ts": start,
+                           "args": dict((name, r[base + i]) for i, name in enumerate(self.counters))})
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def exportCsv(self, filename):
+        base = 3 + 2 * len(self.stages)
+        with open(filename, "w") as f:
+            f.write(",".join(["frame", "frame_ms"] + [name + "_ms" for name in self.stages] + self.counters) + "\n")
+            for r in self.history():
+                values = [str(r[0]), "%.4f" % (r[2] * 1000)]
+                values += ["%.4f" % (r[4 + 2 * i] * 1000) for i in range(len(self.stages))]
+                values += [str(r[base + i]) for i in range(len(self.counters))]
+                f.write(",".join(values) + "\n")
+
+    def export(self, name):
+        self.exportChromeTrace(name + ".json")
+        self.exportCsv(name + ".csv")
+        print ("Wrote frame profile to " + name + ".json and " + name + ".csv")
+
+class QualityGovernor:
+    # Watches how long the last frames took. While they overrun the frame
+    # budget quality steps down a level, once there is headroom again it
+    # steps back up. The thresholds are apart and every level is held for
+    # a while, so it doesn't flap. Transitions are appended to a CSV log.
+    FULL = 0
+    SKIP_RENDER = 1
+    FAST_EXPLOSIONS = 2
+    NAMES = ("full", "skip-render", "fast-explosions")
+
+    def __init__(self, budget, window, hold, log=None):
+        self.budget = budget
+        self.times = collections.deque(maxlen=window)
+        self.hold = hold
+        self.held = 0
+        self.level = QualityGovernor.FULL
+        self.log = log
+        self.transitions = []
+
+    def record(self, seconds):
+        self.times.append(seconds)
+
+    def update(self, frame, now):
+        self.held += 1
+        if self.held < self.hold or len(self.times) < self.times.maxlen:
+            return self.level
+        mean = sum(self.times) / len(self.times)
+        if mean > self.budget * Constants.GOVERNOR_DEGRADE and self.level < QualityGovernor.FAST_EXPLOSIONS:
+            self.change(self.level + 1, frame, now, mean)
+        elif mean < self.budget * Constants.GOVERNOR_RESTORE and self.level > QualityGovernor.FULL:
+            self.change(self.level - 1, frame, now, mean)
+        return self.level
+
+    def change(self, level, frame, now, mean):
+        transition = (frame, now, QualityGovernor.NAMES[self.level], QualityGovernor.NAMES[level], mean * 1000)
+        self.transitions.append(transition)
+        print ("Quality %s -> %s at frame %d, mean frame %.2f ms" % (transition[2], transition[3], frame, transition[4]))
+        if self.log != None:
+            new = not os.path.exists(self.log)
+            with open(self.log, "a") as f:
+                if new:
+                    f.write("frame,time,from,to,meanFrameMs\n")
+                f.write("%d,%.6f,%s,%s,%.3f\n" % transition)
+        self.level = level
+        self.held = 0
+        # Only frames at the new level count towards the next decision
+        self.times.clear()
+
+class KeyboardInput:
+    def wantsStart(self, engine):
+        return pygame.key.get_pressed()[pygame.K_SPACE]
+
+    def steering(self, engine):
+        keys = pygame.key.get_pressed()
+        if keys[pygame.K_LEFT] == keys[pygame.K_RIGHT]:
+            return 0
+        elif keys[pygame.K_LEFT]:
+            return -1
+        return 1
+
+class QueuedInput:
+    # Input sampled on the render thread, read by the simulation thread.
+    # Samples come through a SimpleQueue: the newest steering wins, a start
+    # press is kept until it has been asked for and events pile up until the
+    # next step takes them.
+    def __init__(self, samples):
+        self.samples = samples
+        self.events = []
+        self.steer = 0
+        self.start = False
+
+    def drain(self):
+        while True:
+            try:
+                events, steering, start = self.samples.get_nowait()
+            except queue.Empty:
+                return
+            self.events.extend(events)
+            self.steer = steering
+            self.start = self.start or start
+
+    def takeEvents(self):
+        events = self.events
+        self.events = []
+        return events
+
+    def wantsStart(self, engine):
+        start = self.start
+        self.start = False
+        return start
+
+    def steering(self, engine):
+        return self.steer
+
+# What the render thread gets to see of one simulation tick
+Snapshot = collections.namedtuple("Snapshot", ["frame", "time", "published", "cameraY", "road", "sprites", "placing", "countdown", "timer"])
+
+class InputRecorder:
+    # Passes another input source through and keeps what it answered on every frame
+    LEFT = 1
+    RIGHT = 2
+    START = 4
+    # The quality level changes how the race plays out, so it is kept like an input
+    QUALITY_SHIFT = 3
+
+    def __init__(self, source):
+        self.source = source
+        # inputs[0] is frame first, a ReplayWriter took the ones before
+        self.first = 0
+        self.inputs = bytearray()
+        # AI decisions made on every frame, they depend on how long they took
+        self.decisions = bytearray()
+
+    def mark(self, frame, bit):
+        frame -= self.first
+        if len(self.inputs) <= frame:
+            self.inputs.extend(bytes(frame + 1 - len(self.inputs)))
+        self.inputs[frame] |= bit
+
+    def wantsStart(self, engine):
+        start = self.source.wantsStart(engine)
+        if start:
+            self.mark(engine.frame, InputRecorder.START)
+        return start
+
+    def steering(self, engine):
+        steering = self.source.steering(engine)
+        if steering < 0:
+            self.mark(engine.frame, InputRecorder.LEFT)
+        elif steering > 0:
+            self.mark(engine.frame, InputRecorder.RIGHT)
+        return steering
+
+    def markQuality(self, frame, level):
+        if level:
+            self.mark(frame, level << InputRecorder.QUALITY_SHIFT)
+
+    def markDecisions(self, frame, count):
+        frame -= self.first
+        if len(self.decisions) <= frame:
+            self.decisions.extend(bytes(frame + 1 - len(self.decisions)))
+        self.decisions[frame] = count
+
+    def take(self, frames):
+        # The inputs and decisions of the next frames, padded for frames
+        # where nothing was pressed
+        inputs = self.inputs[:frames]
+        inputs.extend(bytes(frames - len(inputs)))
+        decisions = self.decisions[:frames]
+        decisions.extend(bytes(frames - len(decisions)))
+        del self.inputs[:frames]
+        del self.decisions[:frames]
+        self.first += frames
+        return inputs, decisions
+
+class ReplayInput:
+    def __init__(self, inputs, decisions=None):
+        self.inputs = inputs
+        # None for recordings whose AI decisions were charged a fixed cost
+        self.decisions = decisions
+
+    def get(self, engine):
+        if engine.frame < len(self.inputs):
+            return self.inputs[engine.frame]
+        return 0
+
+    def wantsStart(self, engine):
+        return self.get(engine) & InputRecorder.START != 0
+
+    def steering(self, engine):
+        value = self.get(engine)
+        if value & InputRecorder.LEFT:
+            return -1
+        if value & InputRecorder.RIGHT:
+            return 1
+        return 0
+
+    def quality(self, engine):
+        return self.get(engine) >> InputRecorder.QUALITY_SHIFT & 3
+
+    def decisionLimit(self, engine):
+        if self.decisions == None:
+            return None
+        if engine.frame < len(self.decisions):
+            return self.decisions[engine.frame]
+        return 0
+
+class Replay:
+    # A recorded session: the RNG seed, the time of every frame, the input of
+    # every frame and the number of AI decisions made on every frame. The file
+    # is a header and then chunks of frames, written by ReplayWriter as the
+    # session goes. A chunk holds its inputs and decisions run-length encoded
+    # as (count, value) pairs and its frame times as microsecond deltas.
+    # Version 1 and 2 files are a single block with the frame count in the
+    # header, version 1 has no decisions.
+    MAGIC = b"RGRP"
+    VERSION = 3
+    HEADER = struct.Struct("<4sHI")
+    CHUNK = struct.Struct("<III")
+    BLOCK = struct.Struct("<II")
+    DECISIONS = struct.Struct("<I")
+    RUN = struct.Struct("<HB")
+
+    def __init__(self, seed, micros, inputs, decisions=None):
+        self.seed = seed
+        self.micros = micros
+        self.frames = len(micros) - 1
+        self.inputs = bytearray(inputs)
+        self.inputs.extend(bytes(max(0, self.frames - len(self.inputs))))
+        self.decisions = None
+        if decisions != None:
+            self.decisions = bytearray(decisions)
+            self.decisions.extend(bytes(max(0, self.frames - len(self.decisions))))
+
+    @staticmethod
+    def encodeRuns(values):
+        runs = []
+        for value in values:
+            if runs and runs[-1][1] == value and runs[-1][0] < 0xFFFF:
+                runs[-1][0] += 1
+            else:
+                runs.append([1, value])
+        return runs
+
+    @staticmethod
+    def load(filename):
+        with open(filename, "rb") as f:
+            data = f.read()
+        magic, version, seed = Replay.HEADER.unpack_from(data)
+        if magic != Replay.MAGIC or not version in (1, 2, Replay.VERSION):
+            raise ValueError(filename + " is not a version " + str(Replay.VERSION) + " replay")
+        offset = Replay.HEADER.size
+        micros = [0]
+        inputs = bytearray()
+        decisions = bytearray() if version > 1 else None
+        if version < 3:
+            frames, runCount = Replay.BLOCK.unpack_from(data, offset)
+            offset += Replay.BLOCK.size
+            decisionCount = 0
+            if version > 1:
+                decisionCount, = Replay.DECISIONS.unpack_from(data, offset)
+                offset += Replay.DECISIONS.size
+            offset = Replay.decodeBlock(data, offset, frames, runCount, decisionCount, micros, inputs, decisions)
+            return Replay(seed, micros, inputs, decisions)
+        while offset + Replay.CHUNK.size <= len(data):
+            frames, runCount, decisionCount = Replay.CHUNK.unpack_from(data, offset)
+            size = (runCount + decisionCount) * Replay.RUN.size + frames * 4
+            if offset + Replay.CHUNK.size + size > len(data):
+                # The session ended without closing the file, keep what is whole
+                break
+            offset = Replay.decodeBlock(data, offset + Replay.CHUNK.size, frames, runCount, decisionCount, micros, inputs, decisions)
+        return Replay(seed, micros, inputs, decisions)
+
+    @staticmethod
+    def decodeBlock(data, offset, frames, runCount, decisionCount, micros, inputs, decisions):
+        offset = Replay.decodeRuns(data, offset, runCount, inputs)
+        if decisions != None:
+            offset = Replay.decodeRuns(data, offset, decisionCount, decisions)
+        for delta in struct.unpack_from("<%dI" % frames, data, offset):
+            micros.append(micros[-1] + delta)
+        return offset + frames * 4
+
+    @staticmethod
+    def decodeRuns(data, offset, runCount, values):
+        for count, value in Replay.RUN.iter_unpack(data[offset:offset + runCount * Replay.RUN.size]):
+            values.extend(bytes((value,)) * count)
+        return offset + runCount * Replay.RUN.size
+
+class ReplayWriter:
+    # Streams a session to a replay file while it is recorded. Every
+    # REPLAY_CHUNK frames the frame times, inputs and decisions gathered so
+    # far go to the file, so a long session doesn't pile them up in memory.
+    def __init__(self, filename, seed):
+        self.file = open(filename, "wb")
+        self.file.write(Replay.HEADER.pack(Replay.MAGIC, Replay.VERSION, seed))
+
+    def write(self, clock, recorder):
+        deltas = clock.takeDeltas()
+        if not deltas:
+            return
+        inputs, decisions = recorder.take(len(deltas))
+        runs = Replay.encodeRuns(inputs)
+        decisionRuns = Replay.encodeRuns(decisions)
+        self.file.write(Replay.CHUNK.pack(len(deltas), len(runs), len(decisionRuns)))
+        self.file.write(b"".join(Replay.RUN.pack(count, value) for count, value in runs + decisionRuns))
+        self.file.write(struct.pack("<%dI" % len(deltas), *deltas))
+        self.file.flush()
+
+    def close(self, clock, recorder):
+        self.write(clock, recorder)
+        self.file.close()
+
+class TrackLayout:
+    # The traffic of a whole track as three arrays in spawn order, which is
+    # sorted by y from the start line on: the y of every car, the index of
+    # its lane and of its turn lane, -1 for none. Layouts are saved once per
+    # seed and memory mapped after that, so a reset only reads a header.
+    MAGIC = b"RGTL"
+    VERSION = 1
+    # magic, version, lanes, seed, parameters crc, end, entries
+    HEADER = struct.Struct("<4sHHIIdI4x")
+
+    def __init__(self, seed, params, end, laneCount, y, lane, turnlane, data=None):
+        self.seed = seed
+        self.params = params
+        self.end = end
+        self.laneCount = laneCount
+        self.y = y
+        self.lane = lane
+        self.turnlane = turnlane
+        # Keeps the mapping open as long as the arrays point into it
+        self.data = data
+
+    @staticmethod
+    def parameters(engine):
+        # Anything generateTraffic depends on besides the seed, so a layout
+        # saved before Constants changed is made again
+        lanes = [lane.center for lane in engine.road.lanes]
+        return zlib.crc32(repr((lanes, Constants.NORMAL_CAR_SPEED, Constants.PLAYER_CAR_SPEED,
+                                Constants.PLAYER_CAR_TURNSPEED, Constants.CAR_SIZE)).encode())
+
+    @staticmethod
+    def generate(engine, seed, end):
+        indices = dict((lane, i) for i, lane in enumerate(engine.road.lanes))
+        y, lane, turnlane = [], [], []
+        for yPos, row in engine.generateTraffic(random.Random(seed), end):
+            for l, t in row:
+                y.append(yPos)
+                lane.append(indices[l])
+                turnlane.append(-1 if t == None else indices[t])
+        return TrackLayout(seed, TrackLayout.parameters(engine), end, len(indices),
+                           numpy.array(y, dtype="<f8"), numpy.array(lane, dtype="i1"), numpy.array(turnlane, dtype="i1"))
+
+    @staticmethod
+    def filename(directory, seed):
+        return os.path.join(directory, "track-%08x.layout" % seed)
+
+    @staticmethod
+    def load(engine, seed, end, directory):
+        # The saved layout for seed, generated and saved first if there is none
+        # that fits the current road
+        params = TrackLayout.parameters(engine)
+        if directory == None:
+            return TrackLayout.generate(engine, seed, end)
+        filename = TrackLayout.filename(directory, seed)
+        if os.path.exists(filename):
+            try:
+                with open(filename, "rb") as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, version, laneCount, fileSeed, fileParams, fileEnd, count = TrackLayout.HEADER.unpack_from(data)
+                if (magic, version, laneCount, fileSeed, fileParams, fileEnd) == (TrackLayout.MAGIC, TrackLayout.VERSION, len(engine.road.lanes), seed, params, end):
+                    offset = TrackLayout.HEADER.size
+                    y = numpy.frombuffer(data, "<f8", count, offset)
+                    lane = numpy.frombuffer(data, "i1", count, offset + 8 * count)
+                    turnlane = numpy.frombuffer(data, "i1", count, offset + 9 * count)
+                    # Used last is pruned last
+                    os.utime(filename)
+                    return TrackLayout(seed, params, end, laneCount, y, lane, turnlane, data)
+                data.close()
+            except (OSError, ValueError, struct.error) as e:
+                # Empty or cut short, made again below
+                print ("Could not load track layout: " + str(e))
+        layout = TrackLayout.generate(engine, seed, end)
+        try:
+            layout.save(filename)
+            TrackLayout.prune(directory, Constants.TRACK_CACHE_FILES)
+        except OSError as e:
+            print ("Could not save track layout: " + str(e))
+        return layout
+
+    @staticmethod
+    def prune(directory, keep):
+        # Drops the least recently used layouts past keep
+        names = [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith("track-") and name.endswith(".layout")]
+        if len(names) > keep:
+            names.sort(key=os.path.getmtime)
+            for name in names[:len(names) - keep]:
+                os.remove(name)
+
+    def save(self, filename):
+        def write(f):
+            f.write(TrackLayout.HEADER.pack(TrackLayout.MAGIC, TrackLayout.VERSION, self.laneCount,
+                                            self.seed, self.params, self.end, len(self.y)))
+            f.write(self.y.tobytes())
+            f.write(self.lane.tobytes())
+            f.write(self.turnlane.tobytes())
+        replaceFile(filename, write)
+
+    def chunks(self, size, lanes):
+        # The entries of every size long stretch of track in turn, as
+        # (y, lane, turnlane) with Lane objects
+        n = len(self.y)
+        ascending = self.y[::-1]
+        start = 0
+        chunk = 0
+        while start < n:
+            chunk += 1
+            end = n - int(numpy.searchsorted(ascending, -chunk * size, "right"))
+            yield [(y, lanes[l], None if t < 0 else lanes[t]) for y, l, t in
+                   zip(self.y[start:end].tolist(), self.lane[start:end].tolist(), self.turnlane[start:end].tolist())]
+            start = end
+
+
+def chunkRows(rows, size):
+    # TrackLayout.chunks for traffic that is generated as it goes
+    row = next(rows, None)
+    chunk = 0
+    while row != None:
+        chunk += 1
+        chunkEnd = -chunk * size
+        entries = []
+        while row != None and row[0] > chunkEnd:
+            yPos, lanes = row
+            entries.extend((yPos, lane, turnlane) for lane, turnlane in lanes)
+            row = next(rows, None)
+        yield entries
+
+
 class Controller:
     def __init__(self, engine):
         self.engine = engine
         # Initialize cars
         self.cars = self.engine.aiCars
-        random.shuffle(self.cars)
+        self.engine.rng.shuffle(self.cars)
         # The cars at the start will move slower
         self.accelerations = []
         self.finalPositions = []
         self.passed = []
         for i in range(len(self.cars)):
             self.accelerations.append(Constants.PLAYER_CAR_SPEED * i * .1)
-            self.finalPositions.append((i + 1) * .2 * -self.engine.road.h)
+            self.finalPositions.append((i + 1) * Constants.AI_FINAL_POSITION_SPACING * -self.engine.road.h)
             self.passed.append(False)
         
         #self.accelerations.sort()
@@ -588,17 +2274,12 @@ class Controller:
             
 
     def findNormalCar(self):
-        i = 0
-        mindistance = 10000000
-        while i < len(self.engine.normalCars):
-            car = self.engine.normalCars[i]
-            currentdistance = abs(car.y - self.engine.playerCar.y)
-            if currentdistance < mindistance and car.turnlane != None and currentdistance > 150:
-                mindistance = currentdistance
-                carin = i
-            i += 1
-        self.engine.normalCars[carin].moveNormalCar()
-        #print (self.engine.normalCars[carin])
+        car = self.engine.traffic.nearestTurningCar(self.engine.playerCar.y, 150)
+        if isinstance(car, SleepingCar):
+            car = self.engine.wakeNormalCar(car)
+        if car != None:
+            return car.moveNormalCar()
+        return False
             
     def correctCars(self):
         for i in range(len(self.cars)):
@@ -620,44 +2301,98 @@ class Controller:
         
 class Game:
 
-    def __init__(self):
+    def __init__(self, run=True, clock=None, inputSource=None, render=True, seed=None, record=None, threaded=None):
+        global gameClock
+        # Everything random in a race comes from this seed, so with the same
+        # inputs and frame times a race plays out the same way again
+        self.seed = seed if seed != None else random.getrandbits(32)
+        self.seeded = seed != None
+        self.rng = random.Random(self.seed)
+        self.record = record
+        self.replayWriter = None
+        # Only loop() runs the simulation on a thread of its own, tools that
+        # call step() themselves get the input source they passed in
+        self.threadedLoop = Constants.SIMULATION_THREAD if threaded == None else threaded
+        self.threaded = False
+        self.simulation = None
+        if record != None:
+            clock = RecordingClock()
+            inputSource = InputRecorder(inputSource if inputSource != None else KeyboardInput())
+            self.replayWriter = ReplayWriter(record, self.seed)
+        if clock != None:
+            gameClock = clock
+        self.clock = gameClock
+        self.input = inputSource if inputSource != None else KeyboardInput()
+        self.render = render
+        self.frame = 0
+        self.quality = QualityGovernor.FULL
         self.init()
-        self.loop()
-        self.quit()
+        if run:
+            self.loop()
+            self.quit()
 
     def init(self):
-
+        global assets
+        if assets == None:
+            assets = AssetBundle.open(Constants.ASSET_BUNDLE)
         self.gui = GUI(self, Constants.WINDOW_SIZE, "Racing Game", "")
         self.soundManager = SoundManager()
+        self.normalCarPool = EntityPool(NormalCar, Constants.ENTITY_POOLS)
+        self.explosionPool = EntityPool(Explosion, Constants.ENTITY_POOLS)
+        self.carStore = CarStore()
+        self.entities = EntityRegistry(("objects", "normalCars", "aiCars", "effects"))
+        self.objects = self.entities.view("objects")
+        self.normalCars = self.entities.view("normalCars")
+        self.aiCars = self.entities.view("aiCars")
+        self.effects = self.entities.view("effects")
+        self.profiler = FrameProfiler(["getPlacement", "addChallenge", "doPhysics", "update", "removeDead", "drawObjects"],
+                                      ["pairsTested", "blits", "entitiesUpdated", "sleeping", "aiDeferred", "quality"], Constants.PROFILE_FRAMES)
+        self.governor = QualityGovernor(1.0 / 60, Constants.GOVERNOR_WINDOW, Constants.GOVERNOR_HOLD, Constants.GOVERNOR_LOG)
         self.reset()
         self.score
         self.first = True
+        self.done = False
 
     def reset(self):
         print ("Resetting")
-        self.objects = []
-        self.road = Road(self, 100000, 5)
-        self.objects.append(self.road)
-        self.objects.append(Start(self, (self.road.x, -250), (self.road.w, 250) ) )
-        self.objects.append(Finish(self, (self.road.x, -self.road.h -250), (self.road.w, 250) ) )        
-        self.aiCars = []
-        self.normalCars = []
+        self.recycle(self.entities.clear())
+        self.endless = Constants.ENDLESS
+        self.road = Road(self, Constants.ROAD_LENGTH, 5)
+        self.entities.add(self.road, ("objects",))
+        self.road.addDecal(Constants.START, (self.road.x, -250), (self.road.w, 250) )
+        if not self.endless:
+            self.road.addDecal(Constants.FINISH, (self.road.x, -self.road.h -250), (self.road.w, 250) )
+        self.traffic = TrafficIndex(self.road.lanes, self)
+        self.sleepers = collections.deque()
+        self.updates = 0
         self.score = Score()
         self.scorelist = []
+        self.finished = False
+        self.finishTime = None
+        self.placement = 1
+        self.challenges = 0
         self.placeSensors()
         self.fps = 60
         for i in range(5):
             if i == 2:
                 self.playerCar = PlayerCar( self, (self.road.lanes[i].center - Constants.CAR_SIZE[0] / 2, -Constants.CAR_SIZE[1]))
+                self.entities.add(self.playerCar, ("objects",))
                 car = self.playerCar
             else:
                 car = AICar(self, (self.road.lanes[i].center - Constants.CAR_SIZE[0] / 2, -Constants.CAR_SIZE[1]) ) 
-                self.aiCars.append(car)
-            self.objects.append(car)
+                self.entities.add(car, ("objects", "aiCars"))
+            self.traffic.add(car, mobile=True)
         self.camera = Camera(self.playerCar, Constants.WINDOW_SIZE )
-        self.lastChallenge = time.time()
+        self.broadPhase = SpatialGrid(self.road.x, self.road.lanes[0].w, Constants.COLLISION_CELL_HEIGHT)
+        self.camera.update()
+        self.lastChallenge = gameClock.now()
         self.placeCars()
         self.controller = Controller(self)
+        # Decisions are timed on any real time clock, a recording keeps how
+        # many fit on every frame so its replay makes the same ones
+        timer = time.perf_counter if isinstance(gameClock, RealClock) else None
+        self.aiScheduler = AIScheduler(self.aiCars, Constants.AI_DECISION_INTERVAL, Constants.AI_DECISION_BUDGET,
+                                       timer, Constants.AI_DECISION_COST)
         self.initStateMachine()        
 
     def initStateMachine(self):
@@ -667,37 +2402,56 @@ class Game:
         self.state = self.STATE_WAITING
         
     def quit(self):
+        print ("Texture cache: " + str(Texture.cache.stats()) )
+        print ("Sounds: " + str(self.soundManager.stats()) )
+        print ("AI decisions: " + str(self.aiScheduler.stats()) )
+        if self.replayWriter != None:
+            self.replayWriter.close(self.clock, self.input)
+            print ("Wrote replay to " + self.record)
         self.soundManager.quit()
         pygame.quit()
+        # Fonts die with pygame, the next Game loads its own
+        loadedFonts.clear()
+
+    def events(self):
+        if self.threaded:
+            return self.queuedInput().takeEvents()
+        return pygame.event.get()
+
+    def queuedInput(self):
+        return self.input if isinstance(self.input, QueuedInput) else self.input.source
 
     def doWaitingLogic(self):
-        for event in pygame.event.get():
+        for event in self.events():
             if event.type == pygame.QUIT:
                 self.done = True
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     done = True
-                elif event.key == pygame.K_SPACE:
-                    self.starttime = time.time()
-                    if not self.first:
-                        self.reset()
-                    self.state = self.STATE_COUNTDOWN
+        if self.state == self.STATE_WAITING and self.input.wantsStart(self):
+            self.startRace()
         self.camera.update()
         self.drawObjects()
 
+    def startRace(self):
+        self.starttime = gameClock.now()
+        if not self.first:
+            self.reset()
+        self.state = self.STATE_COUNTDOWN
+
     def doCountdownLogic(self):
-        if time.time() - self.starttime >= 3:
+        if gameClock.now() - self.starttime >= 3:
             self.countdown = "Go!!"
             self.state = self.STATE_PLAYING
             self.score.startTimer()
             
-            self.starttime = time.time()
+            self.starttime = gameClock.now()
 
-        elif time.time() - self.starttime >= 2:
+        elif gameClock.now() - self.starttime >= 2:
             self.countdown = "1"
-        elif time.time() - self.starttime >= 1:
+        elif gameClock.now() - self.starttime >= 1:
             self.countdown = "2"
-        elif time.time() - self.starttime >= 0:
+        elif gameClock.now() - self.starttime >= 0:
             self.countdown = "3"
         
         self.score.countDown(self.countdown)
@@ -706,85 +2460,272 @@ class Game:
 
 
     def doPlayingLogic(self):
-        for event in pygame.event.get():
+        profiler = self.profiler
+        profiler.beginFrame()
+        for event in self.events():
             if event.type == pygame.QUIT:
                 self.done = True
             if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
                 self.done = True
-        if time.time() - self.starttime >= 1:
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                profiler.toggleOverlay()
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                profiler.export(Constants.PROFILE_EXPORT)
+        if gameClock.now() - self.starttime >= 1:
             self.score.countDown("")
-        self.getPlacement()
-        self.addChallenge()
-        self.doPhysics()
-        self.update()
-        self.removeDead()
-        self.drawObjects()
+        profiler.measure("getPlacement", self.getPlacement)
+        profiler.measure("addChallenge", self.addChallenge)
+        profiler.measure("doPhysics", self.doPhysics)
+        profiler.measure("update", self.update)
+        profiler.measure("removeDead", self.removeDead)
+        profiler.measure("drawObjects", self.drawObjects)
+        profiler.setCounter("pairsTested", self.broadPhase.pairsTested)
+        profiler.setCounter("blits", self.gui.blits)
+        profiler.setCounter("entitiesUpdated", self.entitiesUpdated)
+        profiler.setCounter("sleeping", len(self.sleepers))
+        profiler.setCounter("aiDeferred", len(self.aiScheduler.queue))
+        profiler.setCounter("quality", self.quality)
+        profiler.endFrame()
         
 
     def loop(self):
         self.done = False
-        clock = pygame.time.Clock()
+        if self.threadedLoop:
+            self.loopThreaded()
+            return
         
         while not self.done:
-            
-            if self.state == self.STATE_WAITING:
-                self.doWaitingLogic()
-            elif self.state == self.STATE_COUNTDOWN:
-                self.doCountdownLogic()
-            elif self.state == self.STATE_PLAYING:
-                self.doPlayingLogic()
-                
-            clock.tick(self.fps)
+            self.step()
+            self.clock.tick(self.fps)
+
+    def loopThreaded(self):
+        # The simulation ticks at its fixed rate on its own thread and
+        # publishes a snapshot after every tick. This thread only samples
+        # input and draws, interpolating between the last two snapshots.
+        self.snapshots = (None, None)
+        self.hud = Score()
+        self.view = Camera(None, Constants.WINDOW_SIZE)
+        # The source is asked on this thread, the simulation only sees what
+        # came through the queue. A recorder stays outside and keeps what the
+        # simulation saw.
+        self.inputQueue = queue.SimpleQueue()
+        queued = QueuedInput(self.inputQueue)
+        if isinstance(self.input, InputRecorder):
+            self.sampler, self.input.source = self.input.source, queued
+        else:
+            self.sampler, self.input = self.input, queued
+        self.threaded = True
+        self.simulation = threading.Thread(target=self.simulate, name="simulation")
+        self.simulation.start()
+        renderClock = pygame.time.Clock()
+        try:
+            while not self.done and self.simulation.is_alive():
+                events = pygame.event.get()
+                self.inputQueue.put((events, self.sampler.steering(self), self.sampler.wantsStart(self)))
+                previous, current = self.snapshots
+                if current != None:
+                    self.drawSnapshots(previous, current)
+                renderClock.tick(Constants.RENDER_FPS)
+        finally:
+            self.done = True
+            self.simulation.join()
+            self.simulation = None
+            self.threaded = False
+            if isinstance(self.input, InputRecorder):
+                self.input.source = self.sampler
+            else:
+                self.input = self.sampler
+
+    def simulate(self):
+        while not self.done:
+            self.step()
+            self.publish()
+            self.clock.tick(self.fps)
+
+    def publish(self):
+        # Snapshots are never changed after this, so the render thread can
+        # read them without locking. Sprites are collected with a margin
+        # because the view is interpolated between two of them.
+        top, bottom = self.camera.interval()
+        margin = Constants.CAR_SIZE[1]
+        placing = self.score.placingText
+        timer = None
+        if self.score.timerStarted:
+            timer = (self.score.startTime, self.score.startTime + self.finishTime if self.finished else None)
+        snapshot = Snapshot(self.frame, gameClock.now(), time.perf_counter(), self.camera.yOffset, self.road,
+                            tuple(self.collectSprites(top - margin, bottom + margin)),
+                            placing, self.score.countdownText, timer)
+        self.snapshots = (self.snapshots[1], snapshot)
+
+    def drawSnapshots(self, previous, current):
+        # Drawn one tick behind the simulation, so there is a newer snapshot
+        # to interpolate towards. Snapshots are placed on the wall clock when
+        # they were published, the game clock may only move once per tick.
+        now = time.perf_counter() - 1.0 / self.fps
+        alpha = 1.0
+        if previous != None and current.published > previous.published:
+            alpha = min(max((now - previous.published) / (current.published - previous.published), 0.0), 1.0)
+        else:
+            previous = current
+        view = self.view
+        view.yOffset = previous.cameraY + (current.cameraY - previous.cameraY) * alpha
+        gui = self.gui
+        gui.beginDraw(view)
+        current.road.display(gui)
+        before = dict((sprite[0], sprite) for sprite in previous.sprites if sprite[0] != None)
+        for handle, surface, x, y, layer in current.sprites:
+            old = before.get(handle)
+            if old != None:
+                x = old[2] + (x - old[2]) * alpha
+                y = old[3] + (y - old[3]) * alpha
+            gui.submit(surface, (x, y), layer)
+        gui.flushQueue()
+        hud = self.hud
+        hud.displayplacement(current.placing)
+        hud.countDown(current.countdown)
+        hud.timerStarted = current.timer != None
+        if hud.timerStarted:
+            hud.startTime, stopped = current.timer
+            hud.timerStopped = False
+            now = max(previous.time + (current.time - previous.time) * alpha, hud.startTime)
+            hud.display(gui, now if stopped == None else stopped)
+        else:
+            hud.display(gui)
+        self.profiler.display(gui)
+        gui.endDraw()
+
+    def step(self):
+        start = time.perf_counter()
+        if self.replayWriter != None and len(self.clock.deltas) >= Constants.REPLAY_CHUNK:
+            self.replayWriter.write(self.clock, self.input)
+        if self.threaded:
+            self.queuedInput().drain()
+        self.updateQuality()
+        self.soundManager.beginFrame()
+        if self.state == self.STATE_WAITING:
+            self.doWaitingLogic()
+        elif self.state == self.STATE_COUNTDOWN:
+            self.doCountdownLogic()
+        elif self.state == self.STATE_PLAYING:
+            self.doPlayingLogic()
+        self.governor.record(time.perf_counter() - start)
+        self.frame += 1
+
+    def updateQuality(self):
+        # Only a real time clock has frame times worth governing, a replay
+        # plays back the levels it recorded
+        if isinstance(self.input, ReplayInput):
+            self.quality = self.input.quality(self)
+        elif Constants.GOVERNOR and isinstance(gameClock, RealClock):
+            self.quality = self.governor.update(self.frame, gameClock.now())
+        if isinstance(self.input, InputRecorder):
+            self.input.markQuality(self.frame, self.quality)
 
     def update(self):
         self.controller.update()
         self.camera.update()
-        for o in self.objects + self.normalCars:
+        # NormalCars have nothing left to do per frame once the store has moved them
+        arrived, retired = self.carStore.integrate(gameClock.now(), -self.camera.yOffset + self.camera.h + Constants.CAR_SIZE[1])
+        self.updates += 1
+        owners = self.carStore.owners
+        for row in arrived:
+            owners[row].arrive()
+        for row in retired:
+            self.entities.destroy(owners[row])
+        for o in self.objects:
             o.update()
+        limit = self.input.decisionLimit(self) if isinstance(self.input, ReplayInput) else None
+        decisions = self.aiScheduler.run(self.updates, limit)
+        if isinstance(self.input, InputRecorder):
+            self.input.markDecisions(self.frame, decisions)
+        self.entitiesUpdated = len(self.objects) + self.carStore.live
+        self.trafficOffset -= Constants.NORMAL_CAR_SPEED
+        self.streamTraffic()
+        self.wakeTraffic()
         self.processPlayer()
+        self.traffic.update()
         self.doScoring()
         
     def drawObjects(self):
-        self.gui.beginDraw()
-        for o in self.objects + self.normalCars + [self.score]:
-            o.display(self.gui)
+        if not self.render:
+            return
+        if self.quality >= QualityGovernor.SKIP_RENDER and self.frame % 2:
+            # The simulation keeps stepping, only every other frame is drawn
+            return
+        if self.simulation != None:
+            # The render loop draws the published snapshots instead
+            return
+        gui = self.gui
+        gui.beginDraw(self.camera)
+        self.road.display(gui)
+        top, bottom = self.camera.interval()
+        for handle, surface, x, y, layer in self.collectSprites(top, bottom):
+            gui.submit(surface, (x, y), layer)
+        gui.flushQueue()
+        # The score goes on top
+        self.score.display(self.gui)
+        self.profiler.display(self.gui)
         self.gui.endDraw()
+
+    def collectSprites(self, top, bottom):
+        # Culled once against the world y range: every car through the
+        # store's arrays, then the few effects
+        sprites = []
+        store = self.carStore
+        owners = store.owners
+        rows = store.visibleRows(top, bottom, Constants.CAR_SIZE[1])
+        for row, x, y in zip(rows.tolist(), store.x[rows].tolist(), store.y[rows].tolist()):
+            car = owners[row]
+            sprites.append((car.handle, car.texture.surface, x, y, car.layer))
+        for o in self.effects:
+            if o.y < bottom and o.y + o.h > top:
+                sprites.append((o.handle, o.texture.surface, o.x, o.y, o.layer))
+        if Constants.DEBUG_CHECKPOINTS:
+            self.collectCheckpoints(sprites, top, bottom)
+        return sprites
         
     def removeDead(self):
-        for o in list(self.objects):
-            if o.dead:
-                self.objects.remove(o)
-        for c in list(self.normalCars):
-            if c.dead:
-                self.normalCars.remove(c)     
-                
+        dead = self.entities.flush()
+        self.traffic.removeAll(dead)
+        self.recycle(dead)
+
+    def recycle(self, entities):
+        for o in entities:
+            if isinstance(o, Car):
+                self.carStore.remove(o)
+            if o.name == "NormalCar":
+                self.normalCarPool.release(o)
+            elif o.name == "Explosion":
+                self.explosionPool.release(o)
+
     def doPhysics(self):
-        for i in range(len(self.objects)):
-            for j in range(i + 1, len(self.objects)):
-                if CollisionSolver.checkCollision(self.objects[i], self.objects[j]):
-                    self.objects[i].hit(self.objects[j])
-                    self.objects[j].hit(self.objects[i])
-            for car in self.normalCars:
-                if self.camera.canSee((car.x,car.y),(car.w,car.h)):
-                    if CollisionSolver.checkCollision(self.objects[i], car):
-                        self.objects[i].hit(car)
-                        car.hit(self.objects[i])
-        
-                        
+        self.broadPhase.clear()
+        for o in self.objects:
+            self.broadPhase.insert(o)
+        for car in self.normalCars:
+            if self.camera.canSee((car.x,car.y),(car.w,car.h)):
+                self.broadPhase.insert(car, passive=True)
+        for a, b in self.broadPhase.candidatePairs():
+            if CollisionSolver.checkCollision(a, b):
+                a.hit(b)
+                b.hit(a)
+
     def processPlayer(self):
-        keys = pygame.key.get_pressed()
-        if keys[pygame.K_LEFT] == keys[pygame.K_RIGHT]:
+        steering = self.input.steering(self)
+        if steering == 0:
             self.playerCar.goStraight()
-        elif keys[pygame.K_LEFT]:
+        elif steering < 0:
             self.playerCar.goLeft()
-        elif keys[pygame.K_RIGHT]:
+        else:
             self.playerCar.goRight()
         #if keys[pygame.K_SPACE]:
             #self.controller.findNormalCar()
-        if self.playerCar.y < -self.road.h - self.playerCar.h:
+        if not self.endless and self.playerCar.y < -self.road.h - self.playerCar.h:
             self.state = self.STATE_WAITING
             self.first = False
             self.score.stopTimer()
+            self.finished = True
+            self.finishTime = gameClock.now() - self.score.startTime
             
     def getMinDistance(self, lane1, lane2):
         vx = Constants.PLAYER_CAR_TURNSPEED
@@ -801,49 +2742,90 @@ class Game:
         return dy 
         
     def placeCars(self):
+        # Traffic is spawned lazily, one chunk at a time, in traffic space.
+        # A car spawned at y sits at y + trafficOffset in the world.
+        seed = self.rng.getrandbits(32)
+        if self.endless:
+            self.trafficChunks = chunkRows(self.generateTraffic(random.Random(seed), None), Constants.TRAFFIC_CHUNK_SIZE)
+        else:
+            end = -self.road.h * Constants.NORMAL_CAR_SPEED / Constants.PLAYER_CAR_SPEED
+            # Without a seed of its own a game never draws the same layout
+            # seed again, so there is nothing worth saving
+            layout = TrackLayout.load(self, seed, end, Constants.TRACK_CACHE if self.seeded else None)
+            self.trafficChunks = layout.chunks(Constants.TRAFFIC_CHUNK_SIZE, self.road.lanes)
+        self.trafficChunk = 0
+        self.trafficOffset = 0
+        self.streamTraffic()
+
+    def generateTraffic(self, rng, end):
+        # Rows of traffic up to end, forever when end is None
         yPos = -1000
         blankLane = self.road.lanes[0]
         currentLane = self.road.lanes[0]
 
-        end = -self.road.h * Constants.NORMAL_CAR_SPEED / Constants.PLAYER_CAR_SPEED
-        while yPos > end:
-            pathLane = random.choice(self.road.lanes)
+        while end == None or yPos > end:
+            pathLane = rng.choice(self.road.lanes)
             blankLane = pathLane
             while pathLane == blankLane:
-               blankLane = random.choice(self.road.lanes)
+               blankLane = rng.choice(self.road.lanes)
             yMin = self.getMinDistance(pathLane,currentLane)
             ySpace = 50 #self.getRandomLaneSpacing()
             yPos -= yMin + ySpace 
             possibleLanes = list(self.road.lanes)
             possibleLanes.remove(pathLane)
-            for i in range(random.randrange(len(possibleLanes))):
-                lane = random.choice(possibleLanes)
+            row = []
+            for i in range(rng.randrange(len(possibleLanes))):
+                lane = rng.choice(possibleLanes)
                 possibleLanes.remove(lane)
                 if i == 0:
                     adjacent = self.road.getAdjacentLanes(lane)
                     choices = [item for item in adjacent if item in possibleLanes]
                     if len(choices)> 0:
-                        turnlane = random.choice(choices)
+                        turnlane = rng.choice(choices)
                         possibleLanes.remove(turnlane)
                     else:
                         turnlane = None
                 else:
                     turnlane = None            
-                self.addNormalCar(lane, yPos,turnlane)
-        for car in self.normalCars:
-                
-            currentLane = pathLane 
+                row.append((lane, turnlane))
+            yield yPos, row
+
+    def streamTraffic(self):
+        # Spawn every chunk whose near edge is inside the lookahead window
+        horizon = -self.camera.yOffset - Constants.TRAFFIC_LOOKAHEAD
+        while self.trafficChunks != None and -self.trafficChunk * Constants.TRAFFIC_CHUNK_SIZE + self.trafficOffset > horizon:
+            chunk = next(self.trafficChunks, None)
+            if chunk == None:
+                self.trafficChunks = None
+                return
+            self.trafficChunk += 1
+            for yPos, lane, turnlane in chunk:
+                self.spawnNormalCar(lane, yPos + self.trafficOffset, turnlane)
+
     def placeSensors(self):
-        self.sensors = []
-        yPos = 0
+        # Checkpoints are distances from the start line in ascending order,
+        # checkpoint is the index of the next one to pass. An endless road
+        # only has the next one, checkpoint counts the ones passed and only
+        # the latest splits are kept, so memory stays flat
+        spacing = Constants.CHECKPOINT_SPACING
+        self.checkpoints = []
+        self.checkpoint = 0
+        self.checkpointTexture = None
+        self.splits = collections.deque(maxlen=Constants.ENDLESS_SPLITS) if self.endless else []
+        self.lastSensorTime = -1
+        self.lastScoringDistance = 0
+        self.lastScoringTime = None
         self.perfectSensorTimeScore = 5
-        while yPos < self.road.h:
-            yPos += 1000
-            self.sensors.append(Sensor(self, (0, -yPos), (self.gui.w, 10) ) )
+        if self.endless:
+            # doScoring moves it on whenever it is passed
+            self.checkpoints.append(spacing)
+            self.perfectSensorTime = spacing / Constants.PLAYER_CAR_SPEED / 60
+            return
+        while len(self.checkpoints) * spacing < self.road.h:
+            self.checkpoints.append((len(self.checkpoints) + 1) * spacing)
         totalTime = self.road.h / Constants.PLAYER_CAR_SPEED / 60
         print ("Total Time: " + str(totalTime) )
-        self.perfectSensorTime = totalTime / len(self.sensors)
-        self.lastSensorTime = -1
+        self.perfectSensorTime = totalTime / len(self.checkpoints)
                
     
     def addChallenge(self):
@@ -851,16 +2833,51 @@ class Game:
             return
         average = sum(self.scorelist)/len(self.scorelist)
         if average >= Constants.DIFFICULTY:
-            self.controller.findNormalCar()
+            if self.controller.findNormalCar():
+                # Only challenges that actually turned a car are counted
+                self.challenges += 1
             self.playerCar.maxSpeed = Constants.PLAYER_CAR_SPEED + (average - Constants.DIFFICULTY)*5
         else:
             self.playerCar.maxSpeed = Constants.PLAYER_CAR_SPEED
         
-    def addNormalCar(self,lane,yPos,turnlane):
+    def wakeLine(self):
+        # Traffic is awake from just past the top of the screen. Only cars on
+        # screen collide, AI cars further ahead see sleepers through the
+        # traffic index
+        return -self.camera.yOffset - Constants.TRAFFIC_WAKE_DISTANCE
+
+    def spawnNormalCar(self, lane, yPos, turnlane):
+        # Traffic beyond the activation window starts out asleep
+        if yPos < self.wakeLine():
+            sleeper = SleepingCar(self, lane, yPos, turnlane)
+            self.sleepers.append(sleeper)
+            self.traffic.addSleeper(sleeper)
+        else:
+            self.addNormalCar(lane, yPos, turnlane)
+
+    def wakeTraffic(self):
+        wakeY = self.wakeLine()
+        sleepers = self.sleepers
+        while sleepers and (sleepers[0].car != None or sleepers[0].y + Constants.CAR_SIZE[1] / 2 >= wakeY):
+            sleeper = sleepers.popleft()
+            if sleeper.car == None:
+                self.wakeNormalCar(sleeper)
+
+    def wakeNormalCar(self, sleeper):
+        # Also used to wake a car early when something far ahead needs the real car
+        car = self.addNormalCar(sleeper.lane, sleeper.y + Constants.CAR_SIZE[1] / 2, sleeper.turnlane, sleeper.frame)
+        car.yv = sleeper.velocity()
+        sleeper.car = car
+        self.traffic.wake(sleeper)
+        return car
+
+    def addNormalCar(self,lane,yPos,turnlane,frame=None):
         xPos = lane.center
-        c = NormalCar(self, (xPos - Constants.CAR_SIZE[0] / 2, yPos - Constants.CAR_SIZE[1] / 2),turnlane)
-        self.normalCars.append(c)
+        c = self.normalCarPool.acquire(self, (xPos - Constants.CAR_SIZE[0] / 2, yPos - Constants.CAR_SIZE[1] / 2),turnlane,frame)
+        self.entities.add(c, ("normalCars",))
+        self.traffic.add(c)
         #self.addObject(c)
+        return c
 
     def getPlacement(self):
         self.placement = 1
@@ -877,23 +2894,54 @@ class Game:
             self.score.displayplacement(str(self.placement)+ "th")
                 
     def doScoring(self):
-        if len(self.sensors) == 0:
-            return
-        if self.sensors[0].hasPassed(self.playerCar):
-            del self.sensors[0]
-            if self.lastSensorTime != -1:
-                #print ("Time: " + str(time.time() - self.lastSensorTime) )
-                #print ("Perfect Time: " + str(self.perfectSensorTime))
-                score = round(self.perfectSensorTimeScore * self.perfectSensorTime / (time.time() - self.lastSensorTime),3)
-                if score >= 5:
-                    score = 5
-                self.score.add(score)
-                self.scorelist.append(score)
-                if len(self.scorelist) > 5:
-                    del self.scorelist[0]
-    
-            self.addChallenge()
-            self.lastSensorTime = time.time()
+        distance = -self.playerCar.y
+        now = gameClock.now()
+        # A fast enough car can pass several in one frame
+        if self.endless:
+            while self.checkpoints[0] < distance:
+                self.passCheckpoint(self.checkpoints[0], distance, now)
+                self.checkpoints[0] += Constants.CHECKPOINT_SPACING
+                self.checkpoint += 1
+        else:
+            passed = bisect.bisect_left(self.checkpoints, distance)
+            for i in range(self.checkpoint, passed):
+                self.passCheckpoint(self.checkpoints[i], distance, now)
+            self.checkpoint = passed
+        self.lastScoringDistance = distance
+        self.lastScoringTime = now
+
+    def passCheckpoint(self, checkpoint, distance, now):
+        when = self.passingTime(checkpoint, distance, now)
+        self.splits.append(when - self.starttime)
+        if self.lastSensorTime != -1:
+            score = round(self.perfectSensorTimeScore * self.perfectSensorTime / (when - self.lastSensorTime),3)
+            if score >= 5:
+                score = 5
+            self.score.add(score)
+            self.scorelist.append(score)
+            if len(self.scorelist) > 5:
+                del self.scorelist[0]
+
+        self.addChallenge()
+        self.lastSensorTime = when
+
+    def passingTime(self, checkpoint, distance, now):
+        # When the player crossed checkpoint, between the last frame and this one
+        if self.lastScoringTime == None or distance == self.lastScoringDistance:
+            return now
+        t = (checkpoint - self.lastScoringDistance) / (distance - self.lastScoringDistance)
+        return self.lastScoringTime + (now - self.lastScoringTime) * t
+
+    def collectCheckpoints(self, sprites, top, bottom):
+        # Debug view of the checkpoints on screen
+        if self.checkpointTexture == None:
+            self.checkpointTexture = Texture("data/sensor.png")
+            self.checkpointTexture.scaleTo((self.gui.w, Constants.CHECKPOINT_HEIGHT))
+        first = bisect.bisect_right(self.checkpoints, -bottom)
+        last = bisect.bisect_left(self.checkpoints, Constants.CHECKPOINT_HEIGHT - top)
+        for checkpoint in self.checkpoints[first:last]:
+            sprites.append((None, self.checkpointTexture.surface, 0, -checkpoint, 2))
     
 
-Game()
+if __name__ == "__main__":
+    Game(record=Constants.REPLAY_FILE if Constants.RECORD_SESSION else None)
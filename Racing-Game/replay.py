@@ -0,0 +1,53 @@
+# Plays back a session recorded by the game (Constants.REPLAY_FILE, recorded
+# with Constants.RECORD_SESSION on). e.g.
+#   python replay.py last-session.replay
+#   python replay.py last-session.replay --realtime --profile stutter
+# The first form runs headless as fast as the CPU allows, the second opens the
+# window, paces frames like the recorded session, shows the profiler overlay
+# and writes stutter.json and stutter.csv when it is done.
+import argparse
+import importlib
+import os
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("replay")
+    parser.add_argument("--realtime", action="store_true", help="open the window and pace frames like the recording")
+    parser.add_argument("--render", action="store_true", help="draw every frame when running headless")
+    parser.add_argument("--profile", metavar="PREFIX", help="write the frame profile to PREFIX.json and PREFIX.csv")
+    args = parser.parse_args()
+
+    if not args.realtime:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    import Constants
+    game = importlib.import_module("racing-game-fixed")
+
+    replay = game.Replay.load(args.replay)
+    # Keep the timings of every frame instead of the last few seconds
+    Constants.PROFILE_FRAMES = max(Constants.PROFILE_FRAMES, replay.frames)
+    g = game.Game(run=False, clock=game.ReplayClock(replay.micros, args.realtime), inputSource=game.ReplayInput(replay.inputs, replay.decisions),
+                  render=args.realtime or args.render, seed=replay.seed)
+    if args.realtime:
+        g.profiler.toggleOverlay()
+    start = time.perf_counter()
+    while not g.done and g.frame < replay.frames:
+        g.step()
+        g.clock.tick(g.fps)
+    elapsed = time.perf_counter() - start
+
+    print("%d of %d frames in %.2fs (%.0f fps), recorded session took %.2fs" % (
+        g.frame, replay.frames, elapsed, g.frame / elapsed, replay.micros[-1] / 1000000.0))
+    print("finished=%s placement=%s scores=%s" % (g.finished, g.placement, g.scorelist))
+    print("%-13s %8s %8s %8s" % ("ms", "last", "avg", "max"))
+    for name, last, avg, worst in g.profiler.summary():
+        print("%-13s %8.3f %8.3f %8.3f" % (name, last, avg, worst))
+    if args.profile:
+        g.profiler.export(args.profile)
+    g.quit()
+
+
+if __name__ == "__main__":
+    main()